@@ -81,6 +81,9 @@ fi
 if [ -n "$REVISION" ]; then
     PREV_ARG+=("--revision" "$REVISION")
 fi
+if [ -n "$SCAN_CACHE" ]; then
+    PREV_ARG+=("--scan-cache" "$SCAN_CACHE")
+fi
 if [ -n "$CLEAR_PLAN" ]; then
     PREV_ARG+=("--clear-plan")
 fi
@@ -4,6 +4,7 @@ from rich.traceback import install
 from .utils import tqdm
 from .alg import main as alg_main
 import argparse
+import sys
 
 
 class TqdmLoggingHandler(RichHandler):
@@ -94,6 +95,16 @@ def argparse_func():
         help="A debug file with the file packaging results.",
         default=None,
     )
+    parser.add_argument(
+        "--scan-cache",
+        help="Path to a persistent cache of scanned OSTree dirtrees. Unchanged subtrees are not rescanned on the next build.",
+        default=None,
+    )
+    parser.add_argument(
+        "--compress-cache",
+        help="Path to a persistent cache of estimated compressed object sizes.",
+        default=None,
+    )
     parser.add_argument(
         "--clear-plan",
         help="Use a fresh plan, regardless of previous ref.",
@@ -115,6 +126,14 @@ def argparse_func():
         type=int,
         default=None,
     )
+    group.add_argument(
+        "--planner",
+        help="Algorithm for creating a fresh plan. 'greedy' grows each layer "
+        + "from its largest package up to the prefill ratio, 'cluster' merges "
+        + "the packages that update together until they fit in the layers.",
+        choices=["greedy", "cluster"],
+        default=None,
+    )
     group.add_argument(
         "--prefill-ratio",
         help="The amount to prefill layers in the first pass. "
@@ -131,6 +150,110 @@ def argparse_func():
         type=float,
         default=None,
     )
+    group.add_argument(
+        "--class-ratio",
+        help="Packages with the same update history are placed as a single unit, "
+        + "in chunks up to this ratio of the average layer size. "
+        + "Makes planning faster. Set to 0 to place packages one by one.",
+        type=float,
+        default=None,
+    )
+    group.add_argument(
+        "--split-ratio",
+        help="Split packages larger than this ratio of the average layer size "
+        + "(e.g., firmware or unpackaged files) into bins of files of that size, "
+        + "so they are placed in several layers. Set to 0 to disable.",
+        type=float,
+        default=None,
+    )
+    group.add_argument(
+        "--unpackaged-group-size",
+        help="Place directories with at least this many bytes of files that are "
+        + "not part of a package (e.g., 5e7) in their own packages, instead of "
+        + "the unpackaged layer. Set to 0 to disable.",
+        type=lambda v: int(float(v)),
+        default=None,
+    )
+    group.add_argument(
+        "--churn-bytes",
+        help="When reusing a previous plan, rebalance it by moving up to this many "
+        + "bytes of packages between layers (e.g., 5e8). Fixes layers that grew "
+        + "past the max layer size while keeping the rest of the layers. "
+        + "Only the moved bytes count, clients download every layer a move "
+        + "touches in full.",
+        type=lambda v: int(float(v)),
+        default=None,
+    )
+    group.add_argument(
+        "--churn-packages",
+        help="When reusing a previous plan, rebalance it by moving up to this many "
+        + "packages between layers.",
+        type=int,
+        default=None,
+    )
+    group.add_argument(
+        "--compress-sizes",
+        help="Plan layers by the estimated compressed size of their files "
+        + "instead of the uncompressed size.",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+    group.add_argument(
+        "--layer-overhead",
+        help="Fixed time in seconds that clients spend on each changed layer "
+        + "(registry requests and import), besides downloading it. "
+        + "Layers that update often cost more.",
+        type=float,
+        default=None,
+    )
+    group.add_argument(
+        "--pull-concurrency",
+        help="Number of layers clients pull in parallel.",
+        type=int,
+        default=None,
+    )
+    group.add_argument(
+        "--pull-bandwidth",
+        help="Download speed of clients in bytes per second (e.g., 12.5e6).",
+        type=float,
+        default=None,
+    )
+    group.add_argument(
+        "--update-source",
+        help="Where update history comes from. 'changelog' uses package changelogs, "
+        + "'ostree' the content changes across previous commits of the ref, "
+        + "and 'both' combines them.",
+        choices=["changelog", "ostree", "both"],
+        default=None,
+    )
+    group.add_argument(
+        "--update-commits",
+        help="Number of previous commits to compare for the 'ostree' and 'both' "
+        + "update sources.",
+        type=int,
+        default=None,
+    )
+    group.add_argument(
+        "--refine-time",
+        help="Seconds to spend improving a fresh plan by moving and swapping "
+        + "packages between layers after the fill step (0 to disable).",
+        type=float,
+        default=None,
+    )
+    group.add_argument(
+        "--refine-seed",
+        help="Seed for the refinement step.",
+        type=int,
+        default=None,
+    )
+    group.add_argument(
+        "--refine-temp",
+        help="Starting temperature for refining with simulated annealing, "
+        + "as a ratio of the average layer cost. With 0, only improving "
+        + "steps are taken.",
+        type=float,
+        default=None,
+    )
 
     args = parser.parse_args()
 
@@ -157,6 +280,22 @@ def argparse_func():
         max_layers=args.max_layers,
         prefill_ratio=args.prefill_ratio,
         max_layer_ratio=args.max_layer_ratio,
+        class_ratio=args.class_ratio,
+        split_ratio=args.split_ratio,
+        group_size=args.unpackaged_group_size,
+        planner=args.planner,
+        churn_bytes=args.churn_bytes,
+        churn_packages=args.churn_packages,
+        refine_time=args.refine_time,
+        refine_seed=args.refine_seed,
+        refine_temp=args.refine_temp,
+        update_source=args.update_source,
+        update_commits=args.update_commits,
+        compress_sizes=args.compress_sizes,
+        compress_cache=args.compress_cache,
+        layer_overhead=args.layer_overhead,
+        pull_concurrency=args.pull_concurrency,
+        pull_bandwidth=args.pull_bandwidth,
         labels=args.label,
         version=args.version,
         pretty=args.pretty,
@@ -168,13 +307,167 @@ def argparse_func():
         changelog_fn=args.changelog_fn,
         clear_plan=args.clear_plan,
         formatters=formatters,
+        scan_cache=args.scan_cache,
+    )
+
+
+def _list(conv):
+    return lambda v: [conv(x) for x in v.split(",") if x.strip()]
+
+
+def sweep_func(argv: list[str]):
+    from .sweep import sweep
+
+    parser = argparse.ArgumentParser(
+        prog="rechunk sweep",
+        description="Scan an image once and compare the plans of many hyperparameter "
+        + "combinations. Each option takes a comma separated list of values, "
+        + "and options that are not provided are read from meta.yml.",
+    )
+    parser.add_argument(
+        "-r", "--repo", help="Path to the OSTree repo", default="./repo"
+    )
+    parser.add_argument(
+        "-b",
+        "--ref",
+        help="The branch in the OSTree repo to use.",
+        default="master",
+    )
+    parser.add_argument(
+        "-m",
+        "--meta",
+        help="Path to the meta.yml file. A default file is provided.",
+        default=None,
+    )
+    parser.add_argument(
+        "--planner", help="Planners to use (greedy, cluster).", type=_list(str)
+    )
+    parser.add_argument("--max-layers", type=_list(int))
+    parser.add_argument("--prefill-ratio", type=_list(float))
+    parser.add_argument("--max-layer-ratio", type=_list(float))
+    parser.add_argument("--class-ratio", type=_list(float))
+    parser.add_argument(
+        "-j",
+        "--workers",
+        help="Number of worker processes (defaults to the number of cores).",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to write the results table to (CSV).",
+        default="./sweep.csv",
+    )
+    parser.add_argument(
+        "--scan-cache",
+        help="Path to a persistent cache of scanned OSTree dirtrees.",
+        default=None,
+    )
+    parser.add_argument(
+        "--compress-cache",
+        help="Path to a persistent cache of estimated compressed object sizes.",
+        default=None,
+    )
+    args = parser.parse_args(argv)
+
+    sweep(
+        repo=args.repo,
+        ref=args.ref,
+        meta_fn=args.meta,
+        planners=args.planner,
+        max_layers=args.max_layers,
+        prefill_ratios=args.prefill_ratio,
+        max_layer_ratios=args.max_layer_ratio,
+        class_ratios=args.class_ratio,
+        workers=args.workers,
+        result_fn=args.output,
+        scan_cache=args.scan_cache,
+        compress_cache=args.compress_cache,
+    )
+
+
+def multi_func(argv: list[str]):
+    from .multi import plan_images
+
+    parser = argparse.ArgumentParser(
+        prog="rechunk multi",
+        description="Plan several images of the same repo together, so that the "
+        + "content they have in common is placed in identical shared layers.",
+        epilog="Plans are always fresh (no previous manifest), and unpackaged "
+        + "directory groups (unpackaged_group_size), package splitting "
+        + "(layer_split_ratio), compressed sizes (compress_sizes), refinement "
+        + "(refine_time) and rebalancing (churn_bytes, churn_packages) are not "
+        + "supported. These options of meta.yml are ignored with a warning.",
+    )
+    parser.add_argument(
+        "-r", "--repo", help="Path to the OSTree repo", default="./repo"
+    )
+    parser.add_argument(
+        "-b",
+        "--ref",
+        help="The branches of the images in the OSTree repo (comma separated).",
+        type=_list(str),
+        required=True,
+    )
+    parser.add_argument(
+        "-c",
+        "--contentmeta",
+        help="Output paths for the contentmeta of each ref (comma separated).",
+        type=_list(str),
+        required=True,
+    )
+    parser.add_argument(
+        "-m",
+        "--meta",
+        help="Path to the meta.yml file. A default file is provided.",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-layers",
+        help="Maximum number of layers of each image, including the shared ones.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "-l",
+        "--label",
+        help="Add labels to the output images (`label=var`).",
+        action="append",
+    )
+    parser.add_argument(
+        "--result-fn",
+        help="A debug file prefix with the file packaging results.",
+        default=None,
+    )
+    parser.add_argument(
+        "--scan-cache",
+        help="Path to a persistent cache of scanned OSTree dirtrees.",
+        default=None,
+    )
+    args = parser.parse_args(argv)
+
+    plan_images(
+        repo=args.repo,
+        refs=args.ref,
+        contentmeta_fns=args.contentmeta,
+        meta_fn=args.meta,
+        max_layers=args.max_layers,
+        labels=args.label or [],
+        result_fn=args.result_fn,
+        scan_cache=args.scan_cache,
     )
 
 
 def main():
     setup_logger()
     try:
-        argparse_func()
+        if sys.argv[1:2] == ["sweep"]:
+            sweep_func(sys.argv[2:])
+        elif sys.argv[1:2] == ["multi"]:
+            multi_func(sys.argv[2:])
+        else:
+            argparse_func()
     except KeyboardInterrupt:
         logger = logging.getLogger(__name__)
         logger.info("Received keyboard interrupt. Exiting.")
@@ -2,80 +2,179 @@ import fnmatch
 import json
 import logging
 import os
-from typing import Any, Sequence, cast
+import time
+import zlib
+from datetime import datetime
+from typing import Any, NamedTuple, Sequence, cast
 
 import numpy as np
 import yaml
 
 from rechunk.model import MetaPackage, Package
 
-from .fedora import get_packages
-from .model import INFO_KEY, Package, get_layers, get_info, ExportInfo
+from .compress import get_compressed_sizes
+from .filemap import HASH_BYTES, FileMap, HashTable, PatternIndex
+from .ingest import ingest
+from .model import INFO_KEY, Package, PackageArrays, get_layers, get_info, ExportInfo
 from .ostree import (
     calculate_ostree_layers,
     dump_ostree_contentmeta,
-    get_ostree_map,
-    run_with_ostree_files,
+    get_commit_changes,
+)
+from .utils import (
+    get_default_meta_yaml,
+    get_labels,
+    get_cost_model,
+    get_package_arrays,
+    get_packed_update_matrix,
+    pack_update_matrix,
+    tqdm,
 )
-from .utils import get_default_meta_yaml, get_labels, get_update_matrix, tqdm
 
 logger = logging.getLogger(__name__)
 
-
-def prefill_layers(
-    packages: list[MetaPackage],
-    upd_matrix: np.ndarray,
-    max_layers: int,
-    fill_size: int,
-):
-    layers = []
-    logger.info("Prefilling layers.")
-
-    # Use a dict because it maintains order
-    # Important for reproducibility
-    todo = dict.fromkeys(packages)
-    n_segments = upd_matrix.shape[1]
+COMPRESSION_RATIO = 12 / 4.6  # This is for bazzite
+DEDI_RATIO = 0.4  # Assume dedicated layers update a quarter of the time
+# Packages below these sizes are placed in their own layers
+SIZE_LIMITS = (5e5, 1e6)
+# Prefix of the packages made of directories of unpackaged files
+UNPACKAGED_GROUP_PREFIX = "unpackaged/"
+
+
+class PullModel(NamedTuple):
+    """Estimates how long clients take to pull an update.
+
+    Besides its bytes, each changed layer costs a fixed `overhead` (seconds)
+    for registry round trips and its import, which overlaps across the
+    `concurrency` layers that are pulled in parallel. Bytes are downloaded
+    at `bandwidth` (bytes/s)."""
+
+    overhead: float = 0
+    concurrency: int = 1
+    bandwidth: float = 12.5e6
+
+    def layer_bytes(self, ratio: float = 1) -> int:
+        """Fixed cost of a changed layer, as the bytes that would download
+        in the same time. Multiply by `ratio` for uncompressed sizes."""
+        return int(self.overhead * self.bandwidth / self.concurrency * ratio)
+
+    def time(self, download: float, layers: float) -> float:
+        """Seconds to pull `download` compressed bytes in `layers` layers."""
+        return download / self.bandwidth + layers * self.overhead / self.concurrency
+
+
+def get_update_classes(
+    pkgs: PackageArrays, ids: np.ndarray, max_size: int | None
+) -> list[np.ndarray]:
+    """Groups the packages `ids` into classes with identical update rows.
+
+    The planner cannot tell packages in a class apart (other than by
+    size), so it can place each class as a single package. Classes are
+    split into chunks of at most `max_size` bytes, so that a single step
+    does not overfill a layer. Classes are ordered by their first package.
+    Without `max_size`, every package is its own class."""
+    if not max_size or not len(ids):
+        return [ids[i : i + 1] for i in range(len(ids))]
+
+    _, first, inverse, counts = np.unique(
+        pkgs.upd[ids],
+        axis=0,
+        return_index=True,
+        return_inverse=True,
+        return_counts=True,
+    )
+    members = np.split(ids[np.argsort(inverse, kind="stable")], np.cumsum(counts)[:-1])
+
+    classes = []
+    for c in np.argsort(first):
+        chunk_start = 0
+        chunk_size = 0
+        for i, size in enumerate(pkgs.sizes[members[c]]):
+            if chunk_size and chunk_size + size > max_size:
+                classes.append(members[c][chunk_start:i])
+                chunk_start = i
+                chunk_size = 0
+            chunk_size += size
+        classes.append(members[c][chunk_start:])
+    return classes
+
+
+def split_special_layers(pkgs: PackageArrays, max_layers: int):
+    """Places dedicated packages in their own layers and small packages in
+    shared layers. Returns the mask of the packages left to place, the
+    dedicated layers and the small package layers."""
+    # Packages are referred to by index, and candidates are always
+    # considered in index order. Important for reproducibility
+    sizes = pkgs.sizes
+    todo = np.ones(len(sizes), dtype=np.bool)
 
     # Handle dedicated packages
     dedi_layers = []
     dedi = 0
-    for p in packages:
-        if p.dedicated:
-            dedi_layers.append([p])
-            logger.info(
-                f"Layer {dedi+1:2d}: {p.size / 1e9:.3f} GB, dedicated layer for meta '{p.name}'."
-            )
-            dedi += 1
-            todo.pop(p)
+    for i in np.flatnonzero(pkgs.dedicated):
+        dedi_layers.append([int(i)])
+        name = pkgs.packages[i].name if pkgs.packages else f"#{i}"
+        logger.info(
+            f"Layer {dedi+1:2d}: {sizes[i] / 1e9:.3f} GB, dedicated layer for meta '{name}'."
+        )
+        dedi += 1
+        todo[i] = False
 
-    SIZE_LIMITS = (5e5, 1e6)
     max_layers -= len(dedi_layers)
     assert max_layers > len(
         SIZE_LIMITS
     ), "No layers left after dedicated packages and fine layers (set dedicated=False for some packages in meta.yml)."
 
-    # Handle the rest of the layers
-    pbar = tqdm(total=max_layers, desc="Initial layer fill")
-    layers = []
-
     # Add layers for small packages
     # These packages will just ruin the cache
     # in other layers for little benefit
+    layers = []
     for size_limit in SIZE_LIMITS:
-        fines = []
-        for p in packages:
-            if p.size < size_limit and p in todo:
-                fines.append(p)
-                todo.pop(p)
-        if fines:
-            layers.append(fines)
+        fines = np.flatnonzero(todo & (sizes < size_limit))
+        todo[fines] = False
+        if len(fines):
+            layers.append(fines.tolist())
             logger.info(
-                f"Layer {dedi+len(layers):2d}: {sum([p.size for p in fines]) / 1e9:.3f} GB, for small (< {size_limit // 1e6} MB) packages with {len(fines)} packages."
+                f"Layer {dedi+len(layers):2d}: {sizes[fines].sum() / 1e9:.3f} GB, for small (< {size_limit // 1e6} MB) packages with {len(fines)} packages."
             )
-            pbar.update(1)
+
+    return todo, dedi_layers, layers
+
+
+def prefill_layers(
+    pkgs: PackageArrays,
+    max_layers: int,
+    fill_size: int,
+    class_size: int | None = None,
+    layer_overhead: int = 0,
+):
+    """Grows each layer from its largest package, adding the package with
+    the smallest cost increase until the layer reaches `fill_size`.
+
+    Layer costs are its update count times its size plus `layer_overhead`,
+    the fixed cost in bytes of each changed layer (see `PullModel`)."""
+    logger.info("Prefilling layers.")
+    sizes = pkgs.sizes
+    n_words = pkgs.upd.shape[1]
+    todo, dedi_layers, layers = split_special_layers(pkgs, max_layers)
+    dedi = len(dedi_layers)
+    max_layers -= dedi
+
+    # Handle the rest of the layers
+    pbar = tqdm(total=max_layers, initial=len(layers), desc="Initial layer fill")
+
+    # Place packages with identical update rows together
+    classes = get_update_classes(pkgs, np.flatnonzero(todo), class_size)
+    if len(classes) < todo.sum():
+        logger.info(
+            f"Collapsed {todo.sum()} packages into {len(classes)} update classes."
+        )
+    c_todo = np.ones(len(classes), dtype=np.bool)
+    c_sizes = np.array([sizes[c].sum() for c in classes], dtype=np.int64)
+    c_upd = pkgs.upd[[int(c[0]) for c in classes]].reshape(len(classes), n_words)
 
     curr = []
-    l_upd = np.zeros(n_segments, dtype=np.bool)
+    l_upd = np.zeros(n_words, dtype=np.uint64)
     l_size = 0
     while True:
         # We will fill layers in two steps:
@@ -86,8 +185,9 @@ def prefill_layers(
         #
         # There will be packages left over in the end, which will be handled
         # differently.
+        cands = np.flatnonzero(c_todo)
 
-        if l_size > fill_size or not todo:
+        if l_size > fill_size or not len(cands):
             if curr:
                 # Since this also gets hit with not todo
                 # curr might be empty, avoid creating a layer
@@ -95,77 +195,223 @@ def prefill_layers(
                 logger.info(
                     f"Layer {dedi+len(layers):2d}: {l_size / 1e9:.3f} GB with {len(curr):3d} packages."
                 )
-            if len(layers) >= max_layers or not todo:
+            if len(layers) >= max_layers or not len(cands):
                 break
             curr = []
-            l_upd = np.zeros(n_segments, dtype=np.bool)
+            l_upd = np.zeros(n_words, dtype=np.uint64)
             l_size = 0
             pbar.update(1)
-        elif not curr:
-            p = max(todo, key=lambda p: p.size)
-            todo.pop(p)
-            curr.append(p)
-            l_upd |= upd_matrix[p.index]
-            l_size += p.size
         else:
-            # Calculate the bandwidth increase for each package
-            # and select the one with the smallest increase
-            b_upd = None
-            b_pkg = None
-            b_size = 0
-            b_bw = 1e24
-            for p in todo:
-                upd = l_upd | upd_matrix[p.index]
-                new_size = l_size + p.size
-                bw = np.sum(upd) * new_size
-                if bw < b_bw:
-                    b_bw = bw
-                    b_upd = upd
-                    b_pkg = p
-                    b_size = new_size
-
-            assert (
-                b_pkg is not None and b_upd is not None
-            ), "No package selected. How did we get here?"
-
-            todo.pop(b_pkg)
-            curr.append(b_pkg)
-            l_upd = b_upd
-            l_size = b_size
+            if not curr:
+                # Seed the layer with the largest package
+                b_cls = int(cands[np.argmax(c_sizes[cands])])
+            else:
+                # Calculate the bandwidth of the layer with each package
+                # and select the one with the smallest increase.
+                # argmin picks the first minimum, same as a strict loop.
+                bw = pkgs.cost(c_upd[cands] | l_upd) * (
+                    l_size + c_sizes[cands] + layer_overhead
+                )
+                b_cls = int(cands[np.argmin(bw)])
+
+            c_todo[b_cls] = False
+            todo[classes[b_cls]] = False
+            curr.extend(classes[b_cls].tolist())
+            l_upd = l_upd | c_upd[b_cls]
+            l_size += int(c_sizes[b_cls])
 
     pbar.update(1)
     pbar.close()
-    return todo, dedi_layers, layers
+    return np.flatnonzero(todo).tolist(), dedi_layers, layers
+
+
+def cluster_layers(
+    pkgs: PackageArrays,
+    max_layers: int,
+    max_layer_size: int,
+    class_size: int | None = None,
+    layer_overhead: int = 0,
+):
+    """Plans the layers by agglomerative clustering, as an alternative to
+    `prefill_layers` that does not depend on a prefill size.
+
+    Starting with one cluster per update class, the pair of clusters whose
+    merge increases bandwidth the least is merged, until the clusters fit
+    in the layers left after the dedicated and small package layers.
+    Merges past `max_layer_size` are only made when there are no others.
+    The nearest neighbour of each cluster is cached, so only the clusters
+    that pointed to a merged pair are rescored after each merge. Costs
+    include `layer_overhead`, as in `prefill_layers`."""
+    logger.info("Clustering packages into layers.")
+    todo, dedi_layers, layers = split_special_layers(pkgs, max_layers)
+    n_layers = max_layers - len(dedi_layers) - len(layers)
+    n_words = pkgs.upd.shape[1]
+
+    clusters = [
+        c.tolist() for c in get_update_classes(pkgs, np.flatnonzero(todo), class_size)
+    ]
+    n = len(clusters)
+    upd = pkgs.upd[[c[0] for c in clusters]].reshape(n, n_words).copy()
+    size = np.array([pkgs.sizes[c].sum() for c in clusters], dtype=np.int64)
+    cost = pkgs.cost(upd) * (size + layer_overhead)
+    alive = np.ones(n, dtype=np.bool)
+    n_alive = n
+
+    BLOCK = 256
+    constrained = True
+    nn = np.zeros(n, dtype=np.int64)
+    nn_d = np.full(n, np.inf)
+
+    def distances(rows: np.ndarray):
+        # Bandwidth increase of merging each cluster in `rows` with
+        # every other cluster
+        merged = size[rows, None] + size[None, :]
+        d = (
+            pkgs.cost(upd[rows, None, :] | upd[None, :, :]) * (merged + layer_overhead)
+            - cost[rows, None]
+            - cost[None, :]
+        ).astype(np.float64)
+        d[:, ~alive] = np.inf
+        d[np.arange(len(rows)), rows] = np.inf
+        if constrained:
+            d[merged > max_layer_size] = np.inf
+        return d
+
+    def update_nn(rows: np.ndarray):
+        # In blocks to bound memory
+        for start in range(0, len(rows), BLOCK):
+            block = rows[start : start + BLOCK]
+            d = distances(block)
+            nn[block] = np.argmin(d, axis=1)
+            nn_d[block] = d[np.arange(len(block)), nn[block]]
+
+    update_nn(np.arange(n))
+    pbar = tqdm(total=max(n - n_layers, 0), desc="Clustering")
+    while n_alive > n_layers:
+        i = int(np.argmin(nn_d))
+        if not np.isfinite(nn_d[i]):
+            assert constrained, "No clusters left to merge. How did we get here?"
+            logger.warning(
+                f"No merges left within the max layer size with {n_alive} clusters, merging past it."
+            )
+            constrained = False
+            update_nn(np.flatnonzero(alive))
+            continue
+
+        # Merge into the lower index, so that cluster order is stable
+        a, b = sorted((i, int(nn[i])))
+        clusters[a].extend(clusters[b])
+        clusters[b] = []
+        upd[a] |= upd[b]
+        size[a] += size[b]
+        cost[a] = pkgs.cost(upd[a]) * (size[a] + layer_overhead)
+        alive[b] = False
+        nn_d[b] = np.inf
+        n_alive -= 1
+
+        # Clusters that pointed to the merged pair need a new neighbour,
+        # and the merged cluster may now be closer to the rest
+        stale = np.flatnonzero(alive & ((nn == a) | (nn == b)))
+        update_nn(stale[stale != a])
+        d = distances(np.array([a]))[0]
+        nn[a] = np.argmin(d)
+        nn_d[a] = d[nn[a]]
+        closer = alive & (d < nn_d)
+        nn[closer] = a
+        nn_d[closer] = d[closer]
+        pbar.update(1)
+    pbar.close()
+
+    for c in sorted((sorted(c) for c in clusters if c), key=lambda c: c[0]):
+        layers.append(c)
+        logger.info(
+            f"Layer {len(dedi_layers)+len(layers):2d}: {pkgs.sizes[c].sum() / 1e9:.3f} GB with {len(c):3d} packages."
+        )
+    return [], dedi_layers, layers
+
+
+def plan_layers(
+    pkgs: PackageArrays,
+    planner: str,
+    max_layers: int,
+    prefill_size: int,
+    max_layer_size: int,
+    class_size: int | None = None,
+    layer_overhead: int = 0,
+):
+    """Creates a fresh plan with `planner` ('greedy' or 'cluster')."""
+    if planner == "cluster":
+        return cluster_layers(
+            pkgs,
+            max_layers,
+            max_layer_size,
+            class_size=class_size,
+            layer_overhead=layer_overhead,
+        )
+    assert planner == "greedy", f"Unknown planner '{planner}'."
+    return prefill_layers(
+        pkgs,
+        max_layers,
+        prefill_size,
+        class_size=class_size,
+        layer_overhead=layer_overhead,
+    )
 
 
 def fill_layers(
-    todo: dict[MetaPackage, None],
-    layers: list[list[MetaPackage]],
-    upd_matrix: np.ndarray,
+    todo: list[int],
+    layers: list[list[int]],
+    pkgs: PackageArrays,
     max_layer_size: int,
+    class_size: int | None = None,
+    layer_overhead: int = 0,
 ):
     # Fill the layers with the leftover packages
     # We will fill the layers in the same way as before
     # but we will not create new layers.
     # We will insert the package that will cause the
     # minimal bandwidth increase.
+    # Each changed layer also costs `layer_overhead` bytes, so
+    # making a layer update more often costs more than its size.
 
     # Make a copy as we will muate
     if not todo:
         return layers
-    todo = dict(todo)
     layers = [l.copy() for l in layers]
     pbar = tqdm(total=len(todo), desc="Final layer fill")
-    n_segments = upd_matrix.shape[1]
+    n_words = pkgs.upd.shape[1]
 
-    layer_size = [sum([p.size for p in l]) for l in layers]
-    layer_upd = [np.zeros(n_segments, dtype=np.bool) for _ in range(len(layers))]
-    for l in layers:
-        for p in l:
-            layer_upd[layers.index(l)] |= upd_matrix[p.index]
-    layer_bw = [float(np.sum(layer_upd[i]) * layer_size[i]) for i in range(len(layers))]
+    layer_size = np.array([pkgs.sizes[l].sum() for l in layers], dtype=np.int64)
+    layer_upd = np.zeros((len(layers), n_words), dtype=np.uint64)
+    for i, l in enumerate(layers):
+        if l:
+            layer_upd[i] = np.bitwise_or.reduce(pkgs.upd[l], axis=0)
+    layer_bw = (pkgs.cost(layer_upd) * (layer_size + layer_overhead)).astype(
+        np.float64
+    )
 
-    while todo:
+    # Place packages with identical update rows together
+    classes = get_update_classes(pkgs, np.array(todo, dtype=np.int64), class_size)
+    todo_sizes = np.array([pkgs.sizes[c].sum() for c in classes], dtype=np.int64)
+    todo_upd = pkgs.upd[[int(c[0]) for c in classes]].reshape(len(classes), n_words)
+
+    def score(rows):
+        # Bandwidth of each layer in `rows` after adding each package
+        return pkgs.cost(layer_upd[rows, None, :] | todo_upd[None, :, :]) * (
+            layer_size[rows, None] + todo_sizes[None, :] + layer_overhead
+        )
+
+    # Cache the cost of every (layer, package) pair. Adding a package
+    # to a layer only changes the costs of that layer, so only its row
+    # is rescored afterwards. Full layers cost infinity. This takes
+    # O(layers x packages) memory, but a heap would have to be rebuilt
+    # for the changed layer after every pick anyway, and the vectorized
+    # rescoring keeps the picks (and ties) of the original loop.
+    bw_total = score(slice(None))
+    bw = bw_total - layer_bw[:, None]
+    bw[layer_size > max_layer_size] = np.inf
+
+    while classes:
         # There are still some leftover packages.
         # Since we did a heuristic to prefill the layers
         # we left out some space.
@@ -173,89 +419,457 @@ def fill_layers(
         # Now we go back and do a computationally expensive step
         # and insert the packages in the layers that will cause
         # the least bandwidth increase.
-        b_layer = None
-        b_pkg = None
-        b_upd = None
-        b_bw = 1e24
-        b_bw_total = 0
-        for i in range(len(layers)):
-            l_size = layer_size[i]
-            if l_size > max_layer_size:
-                continue
-            for p in todo:
-                upd = layer_upd[i] | upd_matrix[p.index]
-                new_size = l_size + p.size
-                bw_total = np.sum(upd) * new_size
-                bw = bw_total - layer_bw[i]
-                if bw < b_bw:
-                    b_bw = bw
-                    b_layer = i
-                    b_pkg = p
-                    b_upd = upd
-                    b_bw_total = bw_total
-
-        assert (
-            b_layer is not None and b_pkg is not None and b_upd is not None
+        #
+        # Flat argmin picks the first minimum in (layer, package) order,
+        # same as looping over the open layers and packages.
+        b_layer, b_idx = np.unravel_index(int(np.argmin(bw)), bw.shape)
+        b_layer = int(b_layer)
+        assert np.isfinite(
+            bw[b_layer, b_idx]
         ), "No package selected. How did we get here?"
 
-        layers[b_layer].append(b_pkg)
-        layer_upd[b_layer] = b_upd
-        layer_size[b_layer] += b_pkg.size
-        layer_bw[b_layer] = float(b_bw_total)
-        todo.pop(b_pkg)
-        pbar.update(1)
+        b_cls = classes.pop(b_idx)
+        layers[b_layer].extend(b_cls.tolist())
+        layer_upd[b_layer] |= todo_upd[b_idx]
+        layer_size[b_layer] += todo_sizes[b_idx]
+        layer_bw[b_layer] = float(bw_total[b_layer, b_idx])
+        pbar.update(len(b_cls))
+
+        todo_sizes = np.delete(todo_sizes, b_idx)
+        todo_upd = np.delete(todo_upd, b_idx, axis=0)
+        bw_total = np.delete(bw_total, b_idx, axis=1)
+        bw = np.delete(bw, b_idx, axis=1)
+        if layer_size[b_layer] > max_layer_size:
+            bw[b_layer] = np.inf
+        else:
+            bw_total[b_layer] = score([b_layer])[0]
+            bw[b_layer] = bw_total[b_layer] - layer_bw[b_layer]
 
     pbar.close()
     return layers
 
 
-def print_results(
-    dedi_layers: list[list[MetaPackage]],
-    prefill_layers: list[list[MetaPackage]],
-    layers: list[list[MetaPackage]],
-    upd_matrix: np.ndarray,
-    result_fn: str | None = "./results.txt",
+def get_layers_bandwidth(
+    layers: list[list[int]], pkgs: PackageArrays, layer_overhead: int = 0
 ):
-    COMPRESSION_RATIO = 12 / 4.6  # This is for bazzite
-    DEDI_RATIO = 0.4  # Assume dedicated layers update a quarter of the time
+    """Returns the average bytes downloaded per update for `layers`, with
+    `layer_overhead` bytes per changed layer."""
+    total = 0
+    for l in layers:
+        if l:
+            upd = np.bitwise_or.reduce(pkgs.upd[l], axis=0)
+            total += int(pkgs.cost(upd)) * (int(pkgs.sizes[l].sum()) + layer_overhead)
+    return total / pkgs.cost.total
 
-    n_segments = upd_matrix.shape[1]
 
-    # Update matrix for each layer
-    layer_upd = [np.zeros(n_segments, dtype=np.bool) for _ in range(len(layers))]
+def refine_layers(
+    layers: list[list[int]],
+    pkgs: PackageArrays,
+    max_layer_size: int,
+    budget: float,
+    seed: int = 0,
+    temperature: float = 0,
+    layer_overhead: int = 0,
+):
+    """Improves the plan with package moves and swaps between layers for up
+    to `budget` seconds.
+
+    Each step picks a package (in a seeded random order) and applies the
+    best move to another layer or swap with a package of another layer.
+    Layers that would grow past `max_layer_size` are skipped, and the small
+    package layers (see `split_special_layers`) are kept as they are. With a
+    `temperature` (as a ratio of the average layer cost), worse steps are
+    accepted with a probability that decays to zero over the budget
+    (simulated annealing) and the best plan found is returned. Otherwise,
+    only improving steps are accepted and the search stops early once a
+    full pass over the packages finds none. Layer costs include
+    `layer_overhead`, as in `fill_layers`."""
+    layers = [l.copy() for l in layers]
+    order = np.array([p for l in layers for p in l], dtype=np.int64)
+    # Only the small package layers hold packages under the size limits
+    fixed = np.array(
+        [bool(l) and pkgs.sizes[l].max() < SIZE_LIMITS[-1] for l in layers],
+        dtype=np.bool,
+    )
+    if budget <= 0 or len(layers) - fixed.sum() < 2 or not len(order):
+        return layers
+
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    before = get_layers_bandwidth(layers, pkgs, layer_overhead)
+
+    # Per layer update counts for each segment, so that removing a
+    # package from a layer is a subtraction
+    upd = np.unpackbits(
+        pkgs.upd.view(np.uint8), axis=1, count=pkgs.n_segments, bitorder="little"
+    ).astype(np.int32)
+    w = pkgs.cost.segment_weights()
+    sizes = pkgs.sizes
+    where = np.full(len(sizes), -1, dtype=np.int64)
+    cnt = np.zeros((len(layers), pkgs.n_segments), dtype=np.int32)
     for i, l in enumerate(layers):
-        for p in l:
-            layer_upd[i] |= upd_matrix[p.index]
+        where[l] = i
+        cnt[i] = upd[l].sum(axis=0)
+    l_size = np.array([sizes[l].sum() for l in layers], dtype=np.int64)
+    l_cost = ((cnt > 0) @ w) * (l_size + layer_overhead)
+    movable = order[~fixed[where[order]]]
+
+    def fits(new_size, old_size):
+        # Layers may not grow past the limit, but may shrink towards it
+        return (new_size <= max_layer_size) | (new_size <= old_size)
+
+    t0 = temperature * l_cost.mean()
+    best_cost = curr_cost = int(l_cost.sum())
+    best_where = where.copy()
+    steps = 0
+    improved = True
+    timeout = False
+    while (improved or t0) and not timeout:
+        improved = False
+        for p in rng.permutation(movable):
+            elapsed = time.perf_counter() - start
+            if elapsed > budget:
+                timeout = True
+                break
+            steps += 1
+            a = where[p]
+            u = upd[p]
+            s = sizes[p]
+
+            # Moves to every other layer
+            a_size = l_size[a] - s
+            a_cost = int(((cnt[a] - u) > 0) @ w) * (a_size + layer_overhead)
+            m_size = l_size + s
+            m_delta = (
+                a_cost
+                - l_cost[a]
+                + (((cnt + u) > 0) @ w) * (m_size + layer_overhead)
+                - l_cost
+            ).astype(np.float64)
+            m_delta[a] = np.inf
+            m_delta[fixed] = np.inf
+            m_delta[~fits(m_size, l_size)] = np.inf
+
+            # Swaps with every package of another layer
+            qs = movable[where[movable] != a]
+            b = where[qs]
+            sa_size = l_size[a] - s + sizes[qs]
+            sb_size = l_size[b] - sizes[qs] + s
+            s_delta = (
+                (((cnt[a] - u + upd[qs]) > 0) @ w) * (sa_size + layer_overhead)
+                + (((cnt[b] - upd[qs] + u) > 0) @ w) * (sb_size + layer_overhead)
+                - l_cost[a]
+                - l_cost[b]
+            ).astype(np.float64)
+            s_delta[~(fits(sa_size, l_size[a]) & fits(sb_size, l_size[b]))] = np.inf
+
+            m_best = int(np.argmin(m_delta))
+            s_best = int(np.argmin(s_delta)) if len(qs) else -1
+            if s_best >= 0 and s_delta[s_best] < m_delta[m_best]:
+                delta = s_delta[s_best]
+            else:
+                s_best = -1
+                delta = m_delta[m_best]
+
+            if not np.isfinite(delta):
+                continue
+            if delta >= 0:
+                temp = t0 * (1 - elapsed / budget)
+                if temp <= 0 or rng.random() >= np.exp(-delta / temp):
+                    continue
+
+            # Apply the step
+            if s_best >= 0:
+                q = qs[s_best]
+                b = where[q]
+                moves = ((p, a, b), (q, b, a))
+            else:
+                moves = ((p, a, m_best),)
+            for pkg, src, dst in moves:
+                where[pkg] = dst
+                cnt[src] -= upd[pkg]
+                cnt[dst] += upd[pkg]
+                l_size[src] -= sizes[pkg]
+                l_size[dst] += sizes[pkg]
+            for _, src, dst in moves:
+                for i in (src, dst):
+                    l_cost[i] = int((cnt[i] > 0) @ w) * (l_size[i] + layer_overhead)
+
+            curr_cost = int(l_cost.sum())
+            if curr_cost < best_cost:
+                best_cost = curr_cost
+                best_where = where.copy()
+                improved = True
+
+    # Keep the original order of packages within each layer
+    layers = [[] for _ in layers]
+    for p in order:
+        layers[best_where[p]].append(int(p))
+
+    after = get_layers_bandwidth(layers, pkgs, layer_overhead)
+    logger.info(
+        f"Refined layers in {steps} steps ({time.perf_counter() - start:.1f}s). "
+        + f"Bandwidth per update: {before / 1e9:.3f} GB -> {after / 1e9:.3f} GB"
+        + f" ({(1 - after / before) * 100 if before else 0:.1f}% less)."
+    )
+    return layers
+
+
+def rebalance_layers(
+    layers: list[list[int]],
+    pkgs: PackageArrays,
+    max_layer_size: int,
+    churn_bytes: int = 0,
+    churn_packages: int = 0,
+    layer_overhead: int = 0,
+):
+    """Improves a plan that was loaded from a previous manifest, moving at
+    most `churn_bytes` bytes or `churn_packages` packages (0 for no limit
+    on either, but one has to be set) so that the other layers are kept.
+
+    Each step moves the package with the best bandwidth reduction per byte
+    moved. Layers past `max_layer_size` are fixed first, by moving their
+    packages to layers with room (splitting them if the target is empty).
+    If there is no room, the two layers that increase bandwidth the least
+    when merged are merged to free one. An oversized layer is only fixed
+    if the bytes and packages it has to shed fit in what is left of the
+    budget, otherwise it is left as it is.
+
+    The budget counts the bytes moved, while clients download every layer
+    a move touches in full, which is logged at the end. Layer costs include
+    `layer_overhead`, as in `fill_layers`."""
+    layers = [l.copy() for l in layers]
+    order = np.array([p for l in layers for p in l], dtype=np.int64)
+    if (not churn_bytes and not churn_packages) or len(layers) < 2 or not len(order):
+        return layers
+
+    n_layers = len(layers)
+    sizes = pkgs.sizes
+    upd = np.unpackbits(
+        pkgs.upd.view(np.uint8), axis=1, count=pkgs.n_segments, bitorder="little"
+    ).astype(np.int32)
+    w = pkgs.cost.segment_weights()
+    where = np.full(len(sizes), -1, dtype=np.int64)
+    cnt = np.zeros((n_layers, pkgs.n_segments), dtype=np.int32)
+    for i, l in enumerate(layers):
+        where[l] = i
+        cnt[i] = upd[l].sum(axis=0)
+    l_size = np.array([sizes[l].sum() for l in layers], dtype=np.int64)
+    l_or = pack_update_matrix(cnt > 0)
+    l_cost = pkgs.cost(l_or) * (l_size + layer_overhead)
+
+    before = int(l_cost.sum()) / pkgs.cost.total
+
+    def n_over():
+        # Layers with a single package past the limit are fine
+        n_pkgs = np.array([len(l) for l in layers])
+        return int(((l_size > max_layer_size) & (n_pkgs > 1)).sum())
+
+    over_before = n_over()
+    moved_bytes = 0
+    moved = 0
+    touched = set()
+    # Oversized layers that cannot be fixed within the budget
+    stuck = np.zeros(n_layers, dtype=np.bool)
+    # Oversized layers that fit the budget and are being fixed
+    fixing: set[int] = set()
+
+    def left(nbytes: int, npkgs: int = 1):
+        # Whether moving `npkgs` more packages of `nbytes` fits the budget
+        return (not churn_bytes or moved_bytes + nbytes <= churn_bytes) and (
+            not churn_packages or moved + npkgs <= churn_packages
+        )
+
+    def move(p: int, b: int):
+        nonlocal moved_bytes, moved
+        a = int(where[p])
+        layers[a].remove(p)
+        layers[b].append(p)
+        where[p] = b
+        cnt[a] -= upd[p]
+        cnt[b] += upd[p]
+        l_size[a] -= sizes[p]
+        l_size[b] += sizes[p]
+        for i in (a, b):
+            l_or[i] = pack_update_matrix(cnt[i : i + 1] > 0)[0]
+            l_cost[i] = pkgs.cost(l_or[i]) * (l_size[i] + layer_overhead)
+            touched.add(i)
+        moved_bytes += int(sizes[p])
+        moved += 1
+
+    def shed(i: int):
+        # Bytes and fewest packages layer `i` has to move out to fit
+        need = int(l_size[i]) - max_layer_size
+        if need <= 0:
+            return 0, 0
+        largest = np.cumsum(np.sort(sizes[layers[i]])[::-1])
+        return need, int(np.searchsorted(largest, need)) + 1
+
+    while True:
+        s = sizes[order]
+        a = where[order]
+
+        # Only start fixing oversized layers that can be fixed with what is
+        # left of the budget after the ones being fixed
+        n_pkgs = np.array([len(l) for l in layers])
+        oversized = (l_size > max_layer_size) & (n_pkgs > 1)
+        fixing &= set(np.flatnonzero(oversized).tolist())
+        for i in np.flatnonzero(oversized & ~stuck).tolist():
+            if i in fixing:
+                continue
+            need, n_need = shed(i)
+            for j in fixing:
+                need_j, n_j = shed(j)
+                need += need_j
+                n_need += n_j
+            if left(need, n_need):
+                fixing.add(i)
+            else:
+                logger.info(
+                    f"Layer of {l_size[i] / 1e6:.0f} MB cannot be fixed within the churn budget. Skipping."
+                )
+                stuck[i] = True
+
+        # Bandwidth reduction of moving each package to each layer
+        a_cost = (((cnt[a] - upd[order]) > 0) @ w) * (
+            l_size[a] - s + layer_overhead
+        )
+        b_cost = pkgs.cost(l_or[None, :, :] | pkgs.upd[order][:, None, :]) * (
+            l_size[None, :] + s[:, None] + layer_overhead
+        )
+        gain = (l_cost[a] - a_cost)[:, None] + (l_cost[None, :] - b_cost)
+        gain = gain.astype(np.float64)
+        gain[np.arange(len(order)), a] = -np.inf
+        gain[l_size[None, :] + s[:, None] > max_layer_size] = -np.inf
+        gain[[not left(x) for x in s]] = -np.inf
+
+        over = (oversized & ~stuck)[a]
+        if over.any():
+            # Fix oversized layers first, even if bandwidth increases
+            gain[~over] = -np.inf
+            if not np.isfinite(gain.max()):
+                # There is no room, merge the cheapest pair of layers
+                # that fits to free a layer
+                b_pair = None
+                for x in range(n_layers):
+                    for y in range(n_layers):
+                        if (
+                            x == y
+                            or not layers[x]
+                            or not layers[y]
+                            or l_size[x] > l_size[y]
+                            or l_size[x] + l_size[y] > max_layer_size
+                            or not left(int(l_size[x]), len(layers[x]))
+                        ):
+                            continue
+                        d = (
+                            pkgs.cost(l_or[x] | l_or[y])
+                            * (l_size[x] + l_size[y] + layer_overhead)
+                            - l_cost[x]
+                            - l_cost[y]
+                        )
+                        if b_pair is None or d < b_pair[0]:
+                            b_pair = (d, x, y)
+                if b_pair is None:
+                    logger.warning(
+                        "No moves or merges left within the churn budget to fix the oversized layers."
+                    )
+                    stuck[np.unique(a[over])] = True
+                    continue
+                _, x, y = b_pair
+                logger.info(
+                    f"Merging layer of {l_size[x] / 1e6:.0f} MB into layer of {l_size[y] / 1e6:.0f} MB to make room."
+                )
+                for p in list(layers[x]):
+                    move(p, y)
+                continue
+            idx = np.unravel_index(int(np.argmax(gain)), gain.shape)
+        else:
+            # Then, improve bandwidth with the best reduction per byte
+            ratio = np.where(gain > 0, gain / np.maximum(s, 1)[:, None], -np.inf)
+            idx = np.unravel_index(int(np.argmax(ratio)), ratio.shape)
+            if not np.isfinite(ratio[idx]):
+                break
+
+        move(int(order[idx[0]]), int(idx[1]))
+
+    after = int(l_cost.sum()) / pkgs.cost.total
+    logger.info(
+        f"Rebalanced {moved} packages ({moved_bytes / 1e9:.3f} GB) in {len(touched)} layers "
+        + f"({sum(int(l_size[i]) for i in touched) / 1e9:.3f} GB). "
+        + f"Oversized layers: {over_before} -> {n_over()}. "
+        + f"Bandwidth per update: {before / 1e9:.3f} GB -> {after / 1e9:.3f} GB."
+    )
+    return layers
+
+
+def get_plan_stats(
+    dedi_layers: list[list[int]], layers: list[list[int]], pkgs: PackageArrays
+):
+    """Returns the update count of each layer, the bytes downloaded per
+    update (uncompressed) and the layers changed per update of a plan.
+    With a weighted cost model, counts and averages are weighted."""
+    total = pkgs.cost.total
+
+    # Update count for each layer
+    layer_cost = [
+        int(pkgs.cost(np.bitwise_or.reduce(pkgs.upd[l], axis=0))) if l else 0
+        for l in layers
+    ]
 
     # Bandwidth calc
     total_bw = 0
     for i, l in enumerate(layers):
-        total_bw += np.sum(layer_upd[i]) * sum([p.size for p in l])
+        total_bw += layer_cost[i] * int(pkgs.sizes[l].sum())
     for l in dedi_layers:
-        total_bw += np.sum([p.size for p in l]) * n_segments * DEDI_RATIO
+        total_bw += pkgs.sizes[l].sum() * total * DEDI_RATIO
+
+    if pkgs.cost.scale == 1:
+        layer_freq = layer_cost
+    else:
+        layer_freq = [c / pkgs.cost.scale for c in layer_cost]
+    return (
+        layer_freq,
+        total_bw / total,
+        sum(layer_cost) / total + len(dedi_layers) * DEDI_RATIO,
+    )
+
+
+def print_results(
+    dedi_layers: list[list[int]],
+    prefill_layers: list[list[int]],
+    layers: list[list[int]],
+    pkgs: PackageArrays,
+    result_fn: str | None = "./results.txt",
+    compressed: bool = False,
+    pull: PullModel | None = None,
+):
+    sizes = pkgs.sizes
+    packages = pkgs.packages
+    layer_freq, bandwidth, changed = get_plan_stats(dedi_layers, layers, pkgs)
+    # Without compressed sizes, use a fixed estimate for the report
+    ratio = 1 if compressed else COMPRESSION_RATIO
 
     # Detailed package breakdown and frequency analysis
     logger.info(f"Dedicated layers:")
     results = "Dedicated layers:\n"
     for i, l in enumerate(dedi_layers):
-        data = f"{i+1:3d}: (pkg: {len(l):3d}, mb: {sum([p.size for p in l]) / 1e6 / COMPRESSION_RATIO:3.0f}): {l[0].name}"
+        data = f"{i+1:3d}: (pkg: {len(l):3d}, mb: {sizes[l].sum() / 1e6 / ratio:3.0f}): {packages[l[0]].name}"
         results += data + "\n"
-        results += str([p for p in l[0].nevra]) + "\n"
+        results += str([p for p in packages[l[0]].nevra]) + "\n"
         logger.info(data)
 
     logger.info(f"Packages in layers (sorted by frequency):")
     results += "Packages in layers (sorted by frequency):\n"
-    for i, l in sorted(
-        enumerate(layers), key=lambda x: -float(np.sum(layer_upd[x[0]]))
-    ):
-        data = f"{i+1:3d}: (freq: {np.sum(layer_upd[i]):3d}, mb: {sum([p.size for p in l]) / 1e6 / COMPRESSION_RATIO:3.0f}, pkg: {len(l):3d})"
+    for i, l in sorted(enumerate(layers), key=lambda x: -layer_freq[x[0]]):
+        data = f"{i+1:3d}: (freq: {layer_freq[i]:3g}, mb: {sizes[l].sum() / 1e6 / ratio:3.0f}, pkg: {len(l):3d})"
         logger.info(data)
         results += data + "\n"
         results += (
             str(
                 [
-                    f"{p.name}: {p.size // 1e6}"
-                    for p in sorted(l, key=lambda p: p.size, reverse=True)
+                    f"{packages[p].name}: {packages[p].size // 1e6}"
+                    for p in sorted(l, key=lambda p: packages[p].size, reverse=True)
                 ]
             )
             + "\n"
@@ -265,41 +879,109 @@ def print_results(
         with open(result_fn, "w") as f:
             f.write(results)
 
-    logger.info(
-        f"Total per update (uncompressed): {total_bw / (n_segments * 1e9):.3f} GB.\n"
-        + f"Total per update (compressed): {total_bw / (n_segments * 1e9) / COMPRESSION_RATIO:.3f} GB.\n"
-        + f"Layers changed per update: {np.sum([np.sum(u) for u in layer_upd]) / n_segments + len(dedi_layers) * DEDI_RATIO:.1f}."
-    )
+    if compressed:
+        total = f"Total per update (compressed): {bandwidth / 1e9:.3f} GB.\n"
+    else:
+        total = (
+            f"Total per update (uncompressed): {bandwidth / 1e9:.3f} GB.\n"
+            + f"Total per update (compressed): {bandwidth / 1e9 / ratio:.3f} GB.\n"
+        )
+    total += f"Layers changed per update: {changed:.1f}."
+    if pull is not None:
+        total += (
+            f"\nEstimated update time: {pull.time(bandwidth / ratio, changed):.1f} s "
+            + f"({pull.bandwidth * 8 / 1e6:.0f} Mbit/s, {pull.overhead:g} s per layer, "
+            + f"{pull.concurrency} parallel)."
+        )
+    logger.info(total)
+
+
+def _group_by_directory(
+    ostree_map: FileMap, hids: np.ndarray, sizes: np.ndarray, group_size: int
+) -> dict[str, list[int]]:
+    # Walk the directories bottom up, carrying the size of the files that
+    # are not grouped yet to the parent. A directory becomes a group once
+    # it carries `group_size`, and its files are those below it that are
+    # not in a deeper group.
+    file_dir = {}
+    carried: dict[str, int] = {}
+    for hid in hids.tolist():
+        fn = ostree_map.get_path_of_hash(hid)
+        d = fn[: fn.rindex("/")]
+        file_dir[hid] = d
+        carried[d] = carried.get(d, 0) + int(sizes[hid])
+        while d:
+            d = d[: d.rindex("/")]
+            carried.setdefault(d, 0)
+
+    groups = set()
+    for d in sorted(carried, key=lambda d: (-d.count("/"), d)):
+        if d and carried[d] >= group_size:
+            groups.add(d)
+        elif d:
+            carried[d[: d.rindex("/")]] += carried[d]
+
+    out: dict[str, list[int]] = {}
+    for hid, d in file_dir.items():
+        while d and d not in groups:
+            d = d[: d.rindex("/")]
+        if d:
+            out.setdefault(d, []).append(hid)
+    return dict(sorted(out.items()))
 
 
 def process_meta(
     meta: dict[str, Any],
-    ostree_map: dict[str, str],
-    ostree_hash: dict[str, int],
+    ostree_map: FileMap,
+    ostree_hash: HashTable,
     packages: list[Package],
+    group_size: int = 0,
 ) -> tuple[dict[str, str], list[MetaPackage]]:
+    """Groups the files of the image into meta packages, following the
+    meta file and then the packages that own them.
+
+    The remaining files go to the dedicated `unpackaged` meta package. With
+    a `group_size`, directories with at least that many bytes of remaining
+    files become their own packages instead (named `unpackaged<dir>`), so
+    they are planned like the rest."""
     mapping = {}
-    remaining_hashes = dict(ostree_hash)
-    remaining_packages = dict.fromkeys(packages)
+    # Track hashes by id instead of copying the hash table
+    sizes = ostree_hash.sizes
+    remaining = np.ones(len(ostree_hash), dtype=np.bool)
+    # Multilib variants share a name, so index packages by name
+    remaining_packages: dict[str, list[Package]] = {}
+    for p in packages:
+        remaining_packages.setdefault(p.name, []).append(p)
     new_packages = []
     unpackaged = None
 
+    # Match the file patterns of all meta packages in one pass.
+    # A file can only be claimed by the first meta package that
+    # matches it, so only that one needs to see it.
+    pattern_meta = []
+    patterns = []
     for name, contents in meta.items():
-        meta_files = []
+        for file_pat in contents.get("files", []):
+            pattern_meta.append(name)
+            patterns.append(file_pat)
+    pattern_files: dict[str, list[str]] = {}
+    if patterns:
+        matches = PatternIndex(patterns).match(ostree_map)
+        for idx in np.flatnonzero(matches >= 0):
+            pattern_files.setdefault(pattern_meta[matches[idx]], []).append(
+                ostree_map.get_path(idx)
+            )
+
+    for name, contents in meta.items():
+        meta_files = list(pattern_files.get(name, []))
         meta_updates = []
         meta_packages = {}
-        for file_pat in contents.get("files", []):
-            meta_files.extend(fnmatch.filter(ostree_map.keys(), file_pat))
 
         # packages of the same name should always be part of
         # the same meta package due to a name collision
         for pkg_pat in [*contents.get("packages", []), name]:
-            for pname in fnmatch.filter(
-                dict.fromkeys([p.name for p in remaining_packages]), pkg_pat
-            ):
-                pkgs = [p for p in remaining_packages if p.name == pname]
-                for pkg in pkgs:
-                    remaining_packages.pop(pkg, None)
+            for pname in fnmatch.filter(list(remaining_packages), pkg_pat):
+                for pkg in remaining_packages.pop(pname):
                     meta_files.extend([f.name for f in pkg.files])
                     meta_packages[pkg.nevra] = None
                     meta_updates.extend(pkg.updates)
@@ -312,15 +994,13 @@ def process_meta(
                 # Also, lib32 and lib64 packages use the same file
                 continue
 
-            if fn not in ostree_map:
+            hid = ostree_map.get_id(fn)
+            if hid is None or not remaining[hid]:
                 continue
-            ohash = ostree_map[fn]
 
-            if ohash not in remaining_hashes:
-                continue
-
-            mapping[ohash] = name
-            total_size += remaining_hashes.pop(ohash)
+            remaining[hid] = False
+            mapping[ostree_hash.hex(hid)] = name
+            total_size += int(sizes[hid])
             added_files = True
 
         if added_files:
@@ -351,15 +1031,10 @@ def process_meta(
                 new_packages.append(npkg)
 
     # Group different variants of packages together
-    remaining_names = dict.fromkeys([p.name for p in remaining_packages])
-    for name in remaining_names:
+    for name, added_pkg in remaining_packages.items():
         new_size = 0
-        added_pkg = []
         updates = []
-        for pkg in remaining_packages:
-            if pkg.name != name:
-                continue
-            added_pkg.append(pkg)
+        for pkg in added_pkg:
             updates.extend(pkg.updates)
             for f in pkg.files:
                 fn = f.name
@@ -368,18 +1043,13 @@ def process_meta(
                     # Also, lib32 and lib64 packages use the same file
                     continue
 
-                if fn not in ostree_map:
-                    continue
-                ohash = ostree_map[fn]
-
-                if ohash not in remaining_hashes:
+                hid = ostree_map.get_id(fn)
+                if hid is None or not remaining[hid]:
                     continue
 
-                mapping[ohash] = name
-                new_size += remaining_hashes.pop(ohash)
-
-        for pkg in added_pkg:
-            remaining_packages.pop(pkg, None)
+                remaining[hid] = False
+                mapping[ostree_hash.hex(hid)] = name
+                new_size += int(sizes[hid])
 
         new_packages.append(
             MetaPackage(
@@ -392,9 +1062,35 @@ def process_meta(
             )
         )
 
+    # Group large directories of unpackaged files
+    remaining_ids = np.flatnonzero(remaining)
+    if group_size:
+        groups = _group_by_directory(ostree_map, remaining_ids, sizes, group_size)
+        for d, hids in groups.items():
+            name = UNPACKAGED_GROUP_PREFIX + d.lstrip("/")
+            for hid in hids:
+                mapping[ostree_hash.hex(hid)] = name
+            remaining[hids] = False
+            new_packages.append(
+                MetaPackage(
+                    index=len(new_packages),
+                    name=name,
+                    nevra=(name,),
+                    size=int(sizes[hids].sum()),
+                    meta=True,
+                )
+            )
+        if groups:
+            logger.info(
+                f"Grouped unpackaged files into {len(groups)} directories:\n"
+                + str(list(groups))
+            )
+        remaining_ids = np.flatnonzero(remaining)
+
     # Add remaining files to unpackaged
-    for ohash in remaining_hashes:
-        mapping[ohash] = "unpackaged"
+    remaining_size = int(sizes[remaining_ids].sum())
+    for hid in remaining_ids:
+        mapping[ostree_hash.hex(hid)] = "unpackaged"
 
     if unpackaged is None:
         new_packages.append(
@@ -402,7 +1098,7 @@ def process_meta(
                 index=len(new_packages),
                 name="unpackaged",
                 nevra=("unpackaged",),
-                size=sum(remaining_hashes.values()),
+                size=remaining_size,
                 dedicated=True,
                 meta=True,
             )
@@ -413,28 +1109,190 @@ def process_meta(
                 index=len(new_packages),
                 name="unpackaged",
                 nevra=(*unpackaged.nevra, "unpackaged"),
-                size=sum(remaining_hashes.values()) + unpackaged.size,
+                size=remaining_size + unpackaged.size,
                 # updates=unpackaged.updates,
                 dedicated=True,
                 meta=True,
             )
         )
 
-    hash_to_file = {v: k for k, v in ostree_map.items()}
     log = f"Large remaining files:"
-    for hash, size in sorted(
-        remaining_hashes.items(), key=lambda x: x[1], reverse=True
-    )[:50]:
+    largest = remaining_ids[np.argsort(-sizes[remaining_ids], kind="stable")[:50]]
+    for hid in largest:
+        size = sizes[hid]
         if size < 5e5:
             break
-        log += f"\n - {size / 1e6:6.3f} MB {hash_to_file[hash]}"
+        log += f"\n - {size / 1e6:6.3f} MB {ostree_map.get_path_of_hash(hid)}"
     logger.info(log)
 
     return mapping, new_packages
 
 
+def split_large_packages(
+    mapping: dict[str, str],
+    new_packages: list[MetaPackage],
+    ostree_map: FileMap,
+    ostree_hash: HashTable,
+    split_size: int,
+) -> tuple[dict[str, str], list[MetaPackage]]:
+    """Splits meta packages larger than `split_size` into bins of files,
+    so that they can be placed in several layers and pulled in parallel.
+
+    Files are sorted by path and a bin is cut before an anchor file once it
+    holds half of `split_size`. Whether a file is an anchor only depends on
+    its path and size (with a chance proportional to its size, so bins
+    average `split_size`), so an edit only moves the cuts of the bin it
+    falls in and the bins stay stable from build to build. Bins are also
+    cut before they grow past twice `split_size`. The first bin keeps the
+    name of the package and the rest are named `<name>~<hash>`, after the
+    path of their first file.
+
+    With changelogs, all bins share the updates of the package. Measured
+    history (the 'ostree' and 'both' sources, and unpackaged directory
+    groups) is attributed by file, so each bin gets the changes of its own
+    files (see `get_content_history`)."""
+    large = {p.name for p in new_packages if p.size > split_size}
+    if not split_size or not large:
+        return mapping, new_packages
+
+    keys = ostree_hash.digests.view(f"S{HASH_BYTES}").ravel()
+    files: dict[str, list[int]] = {name: [] for name in large}
+    for fhash, name in mapping.items():
+        if name in files:
+            files[name].append(
+                int(np.searchsorted(keys, np.bytes_(bytes.fromhex(fhash))))
+            )
+
+    mapping = dict(mapping)
+    out = []
+    for pkg in new_packages:
+        if pkg.name not in large:
+            out.append(pkg._replace(index=len(out)))
+            continue
+
+        hids = np.array(files[pkg.name], dtype=np.int64)
+        paths = [ostree_map.get_path_of_hash(int(hid)) for hid in hids]
+        order = sorted(range(len(hids)), key=lambda i: paths[i])
+        hids = hids[order]
+        paths = [paths[i] for i in order]
+        sizes = ostree_hash.sizes[hids].tolist()
+
+        half = max(split_size // 2, 1)
+        cuts = [0]
+        acc = 0
+        for i, (path, size) in enumerate(zip(paths, sizes)):
+            if acc >= half and (
+                zlib.crc32(path.encode()) * half < size << 32
+                or acc + size > 2 * split_size
+            ):
+                cuts.append(i)
+                acc = 0
+            acc += size
+        cuts.append(len(hids))
+
+        log = f"Splitting '{pkg.name}' ({sum(sizes) / 1e9:.3f} GB) into {len(cuts) - 1} bins:"
+        for start, end in zip(cuts[:-1], cuts[1:]):
+            in_bin = hids[start:end]
+            name = (
+                pkg.name
+                if start == 0
+                else f"{pkg.name}~{zlib.crc32(paths[start].encode()):08x}"
+            )
+            for hid in in_bin:
+                mapping[ostree_hash.hex(int(hid))] = name
+            size = int(ostree_hash.sizes[in_bin].sum())
+            out.append(pkg._replace(index=len(out), name=name, size=size))
+            log += f"\n - {size / 1e9:.3f} GB {name}"
+        logger.info(log)
+
+    return mapping, out
+
+
+def get_content_history(
+    changes: Sequence[tuple[datetime, Sequence[str]]],
+    ostree_map: FileMap,
+    ostree_hash: HashTable,
+    mapping: dict[str, str],
+    new_packages: Sequence[MetaPackage],
+) -> list[list[datetime]]:
+    """Returns the times the content of each meta package changed, from the
+    changed files of previous commits (see `get_commit_changes`).
+
+    Changed files are attributed by path to the meta package that owns
+    them in the current commit, so files that no longer exist are skipped.
+    A package changes at most once per commit."""
+    # Owning meta package of each hash id
+    index = {p.name: p.index for p in new_packages}
+    owner = np.full(len(ostree_hash), -1, dtype=np.int64)
+    if mapping:
+        keys = ostree_hash.digests.view(f"S{HASH_BYTES}").ravel()
+        digests = np.frombuffer(bytes.fromhex("".join(mapping)), dtype=keys.dtype)
+        owner[np.searchsorted(keys, digests)] = [
+            index[name] for name in mapping.values()
+        ]
+
+    history: list[list[datetime]] = [[] for _ in new_packages]
+    for date, paths in changes:
+        hids = [ostree_map.get_id(fn) for fn in paths]
+        owners = owner[[hid for hid in hids if hid is not None]]
+        for i in np.unique(owners[owners >= 0]):
+            history[i].append(date)
+
+    log = "Packages with the most content changes:"
+    for i in sorted(range(len(history)), key=lambda i: -len(history[i]))[:20]:
+        if not history[i]:
+            break
+        log += f"\n - {len(history[i]):3d} {new_packages[i].name}"
+    logger.info(log)
+    return history
+
+
+def get_update_rows(
+    repo: str,
+    ref: str,
+    mapping: dict[str, str],
+    new_packages: Sequence[MetaPackage],
+    ostree_map: FileMap,
+    ostree_hash: HashTable,
+    horizon: int,
+    bucket: str,
+    source: str = "changelog",
+    n_commits: int = 30,
+    scan_cache: str | None = None,
+):
+    """Returns the packed update rows of `new_packages` and the number of
+    segments, from their changelogs and/or the content changes of the
+    previous `n_commits` commits of `ref`, depending on `source`.
+
+    Unpackaged directory groups have no changelog, so their updates are
+    always measured. If no previous commit can be read, the changelogs
+    are used for all packages."""
+    measured = [
+        p.index for p in new_packages if p.name.startswith(UNPACKAGED_GROUP_PREFIX)
+    ]
+    history = None
+    history_start = None
+    if source != "changelog" or measured:
+        logger.info(f"Measuring content changes over {n_commits} previous commits.")
+        changes = get_commit_changes(
+            repo, ref, n_commits, scan_cache, current=ostree_map
+        )
+        if changes:
+            history = get_content_history(
+                changes, ostree_map, ostree_hash, mapping, new_packages
+            )
+            history_start = changes[-1][0]
+        elif source != "changelog":
+            logger.warning("No previous commits found. Using changelogs instead.")
+            source = "changelog"
+
+    return get_packed_update_matrix(
+        new_packages, horizon, bucket, history, source, measured, history_start
+    )
+
+
 def load_previous_manifest(
-    fn: str | list[str], packages: list[MetaPackage], max_layers: int
+    fn: str | list[str], pkgs: PackageArrays, max_layers: int
 ):
     logger.info(f"Loading previous manifest from '{fn}'.")
     info = None
@@ -477,7 +1335,10 @@ def load_previous_manifest(
     assert layers, "No layers found in previous manifest. Raising."
 
     # Process previous manifest
-    todo = dict.fromkeys(packages)
+    todo = dict.fromkeys(range(len(pkgs.packages)))
+    todo_by_name: dict[str, list[int]] = {}
+    for i, p in enumerate(pkgs.packages):
+        todo_by_name.setdefault(p.name, []).append(i)
     dedi_layers = []
     removed = list()
     prefill = []
@@ -488,32 +1349,28 @@ def load_previous_manifest(
             if name == "null" or not name:
                 continue
 
-            pkg = None
-            for p in todo:
-                if p.name == name:
-                    if pkg is not None:
-                        logger.error(
-                            f"Duplicate package '{name}' found in previous manifest."
-                        )
-                    pkg = p
-
-            if pkg is None:
+            candidates = todo_by_name.get(name, None)
+            if not candidates:
                 removed.append(name)
                 continue
 
+            if len(candidates) > 1:
+                logger.error(f"Duplicate package '{name}' found in previous manifest.")
+            # Keep the last one, packages are consumed as they are found
+            pkg = candidates.pop()
             todo.pop(pkg, None)
 
-            if pkg.dedicated:
+            if pkgs.dedicated[pkg]:
                 dedi_layers.append([pkg])
                 logger.info(
-                    f"Layer {len(dedi_layers)+len(prefill)}: Dedicated layer for meta '{pkg.name}'."
+                    f"Layer {len(dedi_layers)+len(prefill)}: Dedicated layer for meta '{name}'."
                 )
             else:
                 layer.append(pkg)
 
         if layer:
             logger.info(
-                f"Layer {len(dedi_layers)+len(prefill)}: {sum([p.size for p in layer]) // 1e6} MB loaded with {len(layer)} packages."
+                f"Layer {len(dedi_layers)+len(prefill)}: {pkgs.sizes[layer].sum() // 1e6} MB loaded with {len(layer)} packages."
             )
             prefill.append(layer)
 
@@ -522,11 +1379,11 @@ def load_previous_manifest(
         prefill.append([])
 
     if todo:
-        logger.info(f"New packages found:\n{[p.name for p in todo]}")
+        logger.info(f"New packages found:\n{[pkgs.packages[i].name for i in todo]}")
     if removed:
         logger.info(f"The following packages were removed:\n{removed}")
 
-    return todo, dedi_layers, prefill, raw, info
+    return list(todo), dedi_layers, prefill, raw, info
 
 
 def main(
@@ -538,7 +1395,26 @@ def main(
     max_layers: int | None = None,
     prefill_ratio: float | None = None,
     max_layer_ratio: float | None = None,
+    class_ratio: float | None = None,
+    split_ratio: float | None = None,
+    group_size: int | None = None,
+    refine_time: float | None = None,
+    refine_seed: int | None = None,
+    refine_temp: float | None = None,
+    planner: str | None = None,
+    churn_bytes: int | None = None,
+    churn_packages: int | None = None,
     biweekly: bool = False,
+    horizon: int | None = None,
+    bucket: str | None = None,
+    half_life: float | None = None,
+    update_source: str | None = None,
+    update_commits: int | None = None,
+    compress_sizes: bool | None = None,
+    compress_cache: str | None = None,
+    layer_overhead: float | None = None,
+    pull_concurrency: int | None = None,
+    pull_bandwidth: float | None = None,
     result_fn: str | None = "./results.txt",
     labels: Sequence[str] = [],
     version: str | None = None,
@@ -551,6 +1427,7 @@ def main(
     changelog_fn: str | None = None,
     clear_plan: bool = False,
     formatters: dict[str, str] = {},
+    scan_cache: str | None = None,
 ):
     if not meta_fn:
         meta_fn = get_default_meta_yaml()
@@ -562,27 +1439,82 @@ def main(
             prefill_ratio = cast(float, meta.get("layer_prefill_ratio", 0.4))
         if max_layer_ratio is None:
             max_layer_ratio = cast(float, meta.get("layer_max_ratio", 1.3))
+        if class_ratio is None:
+            class_ratio = cast(float, meta.get("layer_class_ratio", 0))
+        if split_ratio is None:
+            split_ratio = cast(float, meta.get("layer_split_ratio", 0))
+        if group_size is None:
+            group_size = int(meta.get("unpackaged_group_size", 0))
+        if refine_time is None:
+            refine_time = cast(float, meta.get("refine_time", 0))
+        if refine_seed is None:
+            refine_seed = cast(int, meta.get("refine_seed", 0))
+        if refine_temp is None:
+            refine_temp = cast(float, meta.get("refine_temp", 0))
+        if planner is None:
+            planner = cast(str, meta.get("planner", "greedy"))
+        if churn_bytes is None:
+            churn_bytes = int(meta.get("churn_bytes", 0))
+        if churn_packages is None:
+            churn_packages = cast(int, meta.get("churn_packages", 0))
+        if horizon is None:
+            horizon = cast(int, meta.get("update_horizon", 365))
+        if bucket is None:
+            bucket = "biweekly" if biweekly else meta.get("update_bucket", "weekly")
+        if half_life is None:
+            half_life = cast(float, meta.get("update_half_life", 0))
+        if update_source is None:
+            update_source = cast(str, meta.get("update_source", "changelog"))
+        if update_commits is None:
+            update_commits = cast(int, meta.get("update_commits", 30))
+        if compress_sizes is None:
+            compress_sizes = cast(bool, meta.get("compress_sizes", False))
+        if layer_overhead is None:
+            layer_overhead = cast(float, meta.get("layer_overhead", 0))
+        if pull_concurrency is None:
+            pull_concurrency = cast(int, meta.get("pull_concurrency", 1))
+        if pull_bandwidth is None:
+            pull_bandwidth = float(meta.get("pull_bandwidth", 12.5e6))
 
     if _cache is not None and ref in _cache:
         # Use cache to speedup experiments
         logger.warning(f"Using cached inmemory data from '{ref}'!")
         ostree_map, ostree_hash, packages = _cache[ref]
+        commits = None
     else:
         logger.info(f"Beginning analysis.")
         logger.info(f"Scanning OSTree repo '{repo}' with ref '{ref}' for files.")
-        ostree_map, ostree_hash = get_ostree_map(repo, ref)
-
-        # Use the database by pulling it from ostree
-        packages = run_with_ostree_files(
-            repo, ostree_map, ["/usr/share/rpm/rpmdb.sqlite"], get_packages
+        # Scan the tree, read the rpm database and get the git log
+        # concurrently
+        ostree_map, ostree_hash, packages, commits = ingest(
+            repo,
+            ref,
+            scan_cache=scan_cache,
+            git_dir=git_dir,
+            revision=revision,
+            previous_manifest=previous_manifest,
+            formatters=formatters,
         )
         logger.info(f"Found {len(packages)} packages.")
         if _cache is not None:
             _cache[ref] = ostree_map, ostree_hash, packages
 
+    # Plan with the compressed size of each object, which is what
+    # clients download
+    plan_hash = ostree_hash
+    if compress_sizes:
+        logger.info("Estimating compressed sizes of content objects.")
+        compressed = get_compressed_sizes(
+            repo,
+            ostree_hash,
+            cache_fn=compress_cache,
+            fallback_ratio=COMPRESSION_RATIO,
+        )
+        plan_hash = HashTable(ostree_hash.digests, compressed)
+
     # Repackage using meta file
     mapping, new_packages = process_meta(
-        meta["meta"], ostree_map, ostree_hash, packages
+        meta["meta"], ostree_map, plan_hash, packages, group_size
     )
 
     logger.info(f"Created {len(new_packages)} meta packages.")
@@ -597,21 +1529,53 @@ def main(
     log += f"\n -   Packages: {package_size / 1e9:6.3f} GB."
     log += f"\n - Unpackaged: {unpackage_size / 1e9:6.3f} GB."
     log += f"\n -      Total: {total_size / 1e9:6.3f} GB."
+    if compress_sizes:
+        total_size = sum(plan_hash.values())
+        log += f"\n - Compressed: {total_size / 1e9:6.3f} GB (planning with compressed sizes)."
     logger.info(log)
 
     # Calculate plan
     layer_size = total_size / max_layers
     prefill_size = int(layer_size * prefill_ratio)
     max_layer_size = int(layer_size * max_layer_ratio)
+    class_size = int(layer_size * class_ratio)
+    split_size = int(layer_size * split_ratio)
+    pull = PullModel(layer_overhead, pull_concurrency, pull_bandwidth)
+    overhead_size = pull.layer_bytes(1 if compress_sizes else COMPRESSION_RATIO)
     logger.info(
         f"Rechunking into {max_layers} layers. Using:\n"
         + f" - Avg Layer size: {layer_size / 1e9:.3f} GB\n"
         + f" -   Prefill size: {prefill_size / 1e9:.3f} GB\n"
-        + f" - Max layer size: {max_layer_size / 1e9:.3f} GB."
+        + f" - Max layer size: {max_layer_size / 1e9:.3f} GB\n"
+        + f" - Max class size: {class_size / 1e9:.3f} GB\n"
+        + f" -     Split size: {split_size / 1e9:.3f} GB\n"
+        + f" - Layer overhead: {overhead_size / 1e9:.3f} GB."
     )
+    if split_size:
+        mapping, new_packages = split_large_packages(
+            mapping, new_packages, ostree_map, plan_hash, split_size
+        )
     logger.info("Creating update matrix.")
-    upd_matrix = get_update_matrix(new_packages, biweekly)
-    logger.info(f"Update matrix shape: {upd_matrix.shape}.")
+    upd_packed, n_segments = get_update_rows(
+        repo,
+        ref,
+        mapping,
+        new_packages,
+        ostree_map,
+        ostree_hash,
+        horizon,
+        cast(str, bucket),
+        update_source,
+        update_commits,
+        scan_cache,
+    )
+    logger.info(
+        f"Update matrix shape: {(len(new_packages), n_segments)} ({bucket} over {horizon} days)."
+    )
+    cost = get_cost_model(n_segments, cast(str, bucket), half_life)
+    if half_life:
+        logger.info(f"Weighting updates with a half-life of {half_life:.0f} days.")
+    pkgs = get_package_arrays(new_packages, upd_packed, n_segments, cost)
 
     found_previous_plan = False
     manifest_json = None
@@ -620,7 +1584,7 @@ def main(
         try:
             logger.info("Loading existing layer data.")
             todo, dedi_layers, prefill, manifest_json, info = load_previous_manifest(
-                previous_manifest, new_packages, max_layers
+                previous_manifest, pkgs, max_layers
             )
             found_previous_plan = True
         except Exception as e:
@@ -631,19 +1595,70 @@ def main(
             logger.warning("Creating a fresh plan due to --clear-plan.")
         else:
             logger.warning("No existing layer data. Expect layer shifts")
-        todo, dedi_layers, prefill = prefill_layers(
-            new_packages, upd_matrix, max_layers, prefill_size
+        todo, dedi_layers, prefill = plan_layers(
+            pkgs,
+            planner,
+            max_layers,
+            prefill_size,
+            max_layer_size,
+            class_size,
+            layer_overhead=overhead_size,
         )
 
     logger.info(
-        f"Leftover packages: {len(todo)}/{len(new_packages)} with a size of {sum([p.size for p in todo]) / 1e9:.3f} GB."
+        f"Leftover packages: {len(todo)}/{len(new_packages)} with a size of {pkgs.sizes[todo].sum() / 1e9:.3f} GB."
     )
     logger.info("Filling layers.")
     # Legacy algorithm simulation
     # prefill[-1] += list(todo.keys())
     # todo = {}
-    layers = fill_layers(todo, prefill, upd_matrix, max_layer_size=max_layer_size)
-    print_results(dedi_layers, prefill, layers, upd_matrix, result_fn)
+    layers = fill_layers(
+        todo,
+        prefill,
+        pkgs,
+        max_layer_size=max_layer_size,
+        class_size=class_size,
+        layer_overhead=overhead_size,
+    )
+    if found_previous_plan and not clear_plan:
+        if refine_time:
+            logger.info("Skipping refinement to keep the previous plan.")
+        if churn_bytes or churn_packages:
+            logger.info(
+                f"Rebalancing layers (budget: {churn_bytes / 1e9:.3f} GB, {churn_packages} packages, 0 for no limit)."
+            )
+            layers = rebalance_layers(
+                layers,
+                pkgs,
+                max_layer_size=max_layer_size,
+                churn_bytes=churn_bytes,
+                churn_packages=churn_packages,
+                layer_overhead=overhead_size,
+            )
+    elif refine_time:
+        logger.info(f"Refining layers for up to {refine_time:.0f}s.")
+        layers = refine_layers(
+            layers,
+            pkgs,
+            max_layer_size=max_layer_size,
+            budget=refine_time,
+            seed=refine_seed,
+            temperature=refine_temp,
+            layer_overhead=overhead_size,
+        )
+    print_results(
+        dedi_layers,
+        prefill,
+        layers,
+        pkgs,
+        result_fn,
+        compressed=compress_sizes,
+        pull=pull,
+    )
+
+    # Back to packages for the OSTree mapping
+    dedi_layers = [[new_packages[i] for i in l] for l in dedi_layers]
+    layers = [[new_packages[i] for i in l] for l in layers]
 
     final_layers, ostree_out = calculate_ostree_layers(dedi_layers, layers, mapping)
     new_labels, timestamp = get_labels(
@@ -660,6 +1675,7 @@ def main(
         changelog_fn=changelog_fn,
         info=info,
         formatters=formatters,
+        commits=commits,
     )
 
     if contentmeta_fn:
@@ -0,0 +1,135 @@
+import logging
+import os
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+from .filemap import HashTable
+from .ostree import get_object_fn
+from .utils import load_pickle_cache, save_pickle_cache, tqdm
+
+logger = logging.getLogger(__name__)
+
+# Layers are gzip compressed when encapsulating, so estimate with deflate
+# at the default level of gzip
+COMPRESS_LEVEL = 6
+# Large files are estimated from evenly spaced blocks instead of in full
+SAMPLE_BLOCK = 1 << 16
+SAMPLE_BLOCKS = 8
+
+COMPRESS_CACHE_VERSION = 1
+COMPRESS_CACHE_MAX_OBJECTS = 1_500_000
+
+
+def _estimate_compressed(fn: str) -> int:
+    try:
+        with open(fn, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= SAMPLE_BLOCK * SAMPLE_BLOCKS:
+                sample = f.read()
+            else:
+                blocks = []
+                for i in range(SAMPLE_BLOCKS):
+                    f.seek((size - SAMPLE_BLOCK) * i // (SAMPLE_BLOCKS - 1))
+                    blocks.append(f.read(SAMPLE_BLOCK))
+                sample = b"".join(blocks)
+    except OSError:
+        return -1
+
+    if not sample:
+        return 0
+    # Raw deflate, the gzip header is per layer, not per file
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    out = len(c.compress(sample)) + len(c.flush())
+    return -(-size * out // len(sample))
+
+
+def _get_compress_header():
+    # Sizes are only valid for the parameters they were estimated with
+    return {
+        "version": COMPRESS_CACHE_VERSION,
+        "params": (COMPRESS_LEVEL, SAMPLE_BLOCK, SAMPLE_BLOCKS),
+    }
+
+
+def load_compress_cache(fn: str) -> dict[bytes, int]:
+    """Loads the compressed size cache (digest to compressed size).
+    Returns an empty cache on any failure."""
+    cache = load_pickle_cache(fn, "compress cache", _get_compress_header())
+    return cache["sizes"] if cache is not None else {}
+
+
+def save_compress_cache(fn: str, sizes: dict[bytes, int], current: set[bytes]):
+    """Saves the compressed size cache. If it grows past the limit, only
+    the objects of the current image are kept."""
+    if len(sizes) > COMPRESS_CACHE_MAX_OBJECTS:
+        sizes = {k: v for k, v in sizes.items() if k in current}
+
+    save_pickle_cache(
+        fn, "compress cache", {**_get_compress_header(), "sizes": sizes}
+    )
+    logger.info(f"Saved compress cache '{fn}' with {len(sizes)} objects.")
+
+
+def get_compressed_sizes(
+    repo: str,
+    hashes: HashTable,
+    workers: int | None = None,
+    cache_fn: str | None = None,
+    fallback_ratio: float = 1,
+) -> np.ndarray:
+    """Estimates the compressed size of every content object in `hashes`,
+    indexed by hash id.
+
+    Objects are read from the repo and compressed in a process pool, with
+    large objects sampled. Sizes are cached by object hash, so only new
+    objects are compressed on the next build. Objects that cannot be read
+    (e.g., in archive repos) are assumed to compress by `fallback_ratio`."""
+    cache = load_compress_cache(cache_fn) if cache_fn else {}
+    keys = [d.tobytes() for d in hashes.digests]
+    out = np.fromiter(
+        (cache.get(k, -1) for k in keys), dtype=np.int64, count=len(keys)
+    )
+    # Empty files and symlinks are free
+    out[hashes.sizes == 0] = 0
+
+    todo = np.flatnonzero(out < 0)
+    logger.info(
+        f"Compressed sizes: {len(keys) - len(todo)} cached, {len(todo)} to compress."
+    )
+    if len(todo):
+        fns = [get_object_fn(repo, hashes.hex(int(hid)), "file") for hid in todo]
+        with Pool(workers) as pool:
+            res = list(
+                tqdm(
+                    pool.imap(_estimate_compressed, fns, chunksize=64),
+                    total=len(fns),
+                    desc="Estimating compressed sizes",
+                    unit="files",
+                )
+            )
+        out[todo] = res
+        for hid, size in zip(todo.tolist(), res):
+            if size >= 0:
+                cache[keys[hid]] = size
+
+    missing = out < 0
+    if missing.any():
+        logger.warning(
+            f"Could not read {int(missing.sum())} objects. Assuming a compression ratio of {fallback_ratio:.2f}."
+        )
+        out[missing] = (hashes.sizes[missing] / fallback_ratio).astype(np.int64)
+
+    if cache_fn:
+        try:
+            save_compress_cache(cache_fn, cache, set(keys))
+        except OSError as e:
+            logger.error(f"Failed to save compress cache '{cache_fn}':\n{e}")
+
+    total = int(hashes.sizes.sum())
+    logger.info(
+        f"Estimated compressed size: {out.sum() / 1e9:.3f} GB "
+        + f"({total / max(int(out.sum()), 1):.2f}x smaller)."
+    )
+    return out
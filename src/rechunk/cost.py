@@ -0,0 +1,72 @@
+# Update cost model of the planner.
+#
+# The cost of a layer is the number of segments of the update matrix in which
+# it changes, times its size. Segments can be weighted, e.g., so that recent
+# updates count more than old ones. Weights are scaled to integers, so that
+# costs stay exact and plans reproducible, and layer costs are computed as
+# popcounts (equal weights) or weighted popcounts over packed update rows.
+
+import numpy as np
+
+# Weight of the heaviest segment when weighting
+WEIGHT_SCALE = 1 << 16
+
+
+def get_decay_weights(n_segments: int, segment_days: float, half_life: float):
+    """Returns exponentially decaying weights for segments counted back
+    from today, halving every `half_life` days."""
+    age = np.arange(n_segments) * segment_days
+    return 0.5 ** (age / half_life)
+
+
+class CostModel:
+    """Counts the (weighted) segments set in packed update rows.
+
+    Without weights, this is a popcount and the counts are plain update
+    counts. Otherwise, each packed byte is looked up in a per byte table
+    with the sum of the weights of its set bits."""
+
+    def __init__(self, n_segments: int, weights: np.ndarray | None = None):
+        self.n_segments = n_segments
+        if weights is None:
+            self.weights = None
+            self.scale = 1
+            return
+
+        assert len(weights) == n_segments, "One weight per segment is required."
+        assert np.all(weights >= 0) and np.any(weights > 0), "Invalid weights."
+        self.weights = np.round(weights / weights.max() * WEIGHT_SCALE).astype(
+            np.int64
+        )
+        self.scale = WEIGHT_SCALE
+
+        # Bits are packed little endian (see `pack_update_matrix`)
+        n_bytes = -(-n_segments // 64) * 8
+        padded = np.zeros(n_bytes * 8, dtype=np.int64)
+        padded[:n_segments] = self.weights
+        bits = np.unpackbits(
+            np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder="little"
+        ).astype(np.int64)
+        self._tables = padded.reshape(n_bytes, 8) @ bits.T
+        self._byte_idx = np.arange(n_bytes)
+
+    @property
+    def total(self) -> int:
+        """Cost of updating in every segment, used to average costs."""
+        if self.weights is None:
+            return self.n_segments
+        return int(self.weights.sum())
+
+    def segment_weights(self) -> np.ndarray:
+        """Integer weight of each segment, for per segment count arrays."""
+        if self.weights is None:
+            return np.ones(self.n_segments, dtype=np.int64)
+        return self.weights
+
+    def __call__(self, packed: np.ndarray) -> np.ndarray:
+        """Returns the weighted number of segments set in each packed row
+        (last axis)."""
+        if self.weights is None:
+            return np.bitwise_count(packed).sum(axis=-1, dtype=np.int64)
+        b = np.ascontiguousarray(packed).view(np.uint8)
+        return self._tables[self._byte_idx, b].sum(axis=-1)
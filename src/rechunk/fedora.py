@@ -1,9 +1,30 @@
 import logging
+import os
+import sqlite3
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from typing import Literal
 
 from .model import File, Package
+from .rpmdb import (
+    RPMTAG_ARCH,
+    RPMTAG_BASENAMES,
+    RPMTAG_CHANGELOGTIME,
+    RPMTAG_DIRINDEXES,
+    RPMTAG_DIRNAMES,
+    RPMTAG_EPOCH,
+    RPMTAG_FILESIZES,
+    RPMTAG_LONGFILESIZES,
+    RPMTAG_LONGSIZE,
+    RPMTAG_NAME,
+    RPMTAG_OLDFILENAMES,
+    RPMTAG_RELEASE,
+    RPMTAG_SIZE,
+    RPMTAG_VERSION,
+    read_blobs,
+    read_header,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -11,9 +32,159 @@ logger = logging.getLogger(__name__)
 # issues with them being in changelogs.
 STARTSEP = "M2Dqm7H6"
 ENDSEP = "7mhjAuF8"
+TIMESEP = "Xc9rT4pW"
 
 
-def get_packages(dir: str):
+RPMDB_FN = "rpmdb.sqlite"
+RPMDB_TAGS = frozenset(
+    [
+        RPMTAG_NAME,
+        RPMTAG_VERSION,
+        RPMTAG_RELEASE,
+        RPMTAG_EPOCH,
+        RPMTAG_ARCH,
+        RPMTAG_SIZE,
+        RPMTAG_LONGSIZE,
+        RPMTAG_FILESIZES,
+        RPMTAG_LONGFILESIZES,
+        RPMTAG_OLDFILENAMES,
+        RPMTAG_DIRINDEXES,
+        RPMTAG_BASENAMES,
+        RPMTAG_DIRNAMES,
+        RPMTAG_CHANGELOGTIME,
+    ]
+)
+
+
+def get_packages(dir: str, workers: int | None = None):
+    # Prefer reading the database directly, which avoids the rpm
+    # binary and parsing its text output
+    try:
+        return get_packages_rpmdb(dir, workers)
+    except (OSError, sqlite3.Error, AssertionError, ValueError) as e:
+        logger.warning(
+            f"Could not read '{RPMDB_FN}' directly ({e}). Falling back to 'rpm -qa'."
+        )
+    return get_packages_rpm(dir)
+
+
+def _parse_header(blob: bytes):
+    hdr = read_header(blob, RPMDB_TAGS)
+
+    name = hdr[RPMTAG_NAME]
+    version = hdr.get(RPMTAG_VERSION, "")
+    release = hdr.get(RPMTAG_RELEASE, "")
+    epoch = hdr.get(RPMTAG_EPOCH, None)
+    arch = hdr.get(RPMTAG_ARCH, None)
+    # Same as the %{NEVRA} query tag
+    nevra = f"{name}-{f'{epoch[0]}:' if epoch else ''}{version}-{release}"
+    if arch:
+        nevra += f".{arch}"
+
+    size = (hdr.get(RPMTAG_LONGSIZE, None) or hdr.get(RPMTAG_SIZE, None) or [0])[0]
+
+    if RPMTAG_BASENAMES in hdr:
+        dirnames = hdr.get(RPMTAG_DIRNAMES, [])
+        fns = [
+            dirnames[d] + b
+            for d, b in zip(hdr.get(RPMTAG_DIRINDEXES, []), hdr[RPMTAG_BASENAMES])
+        ]
+    else:
+        fns = hdr.get(RPMTAG_OLDFILENAMES, [])
+    fsizes = hdr.get(RPMTAG_LONGFILESIZES, None) or hdr.get(RPMTAG_FILESIZES, [])
+    files = tuple(File(fn, fsize) for fn, fsize in zip(fns, fsizes))
+
+    updates = tuple(
+        datetime.fromtimestamp(t) for t in hdr.get(RPMTAG_CHANGELOGTIME, [])
+    )
+
+    return Package(name, nevra, size, files, updates, version, release)
+
+
+def get_packages_rpmdb(dir: str, workers: int | None = None):
+    """Reads the packages by decoding the header blobs of `rpmdb.sqlite`.
+
+    If `workers` is larger than 1, headers are decoded in a process pool."""
+    fn = os.path.join(dir, RPMDB_FN)
+    if not os.path.isfile(fn):
+        raise FileNotFoundError(fn)
+
+    blobs = read_blobs(fn)
+    if workers is not None and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_parse_header, blobs, chunksize=64))
+    return [_parse_header(blob) for blob in blobs]
+
+
+def get_packages_rpm(dir: str):
+    try:
+        return get_packages_rpm_times(dir)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logger.warning(
+            f"Failed to query changelog times ({e}). Falling back to parsing changelogs."
+        )
+    return get_packages_rpm_changes(dir)
+
+
+def get_packages_rpm_times(dir: str):
+    # Query the changelog times as epochs instead of the changelog text,
+    # which is much smaller and needs no date parsing
+    packages = []
+
+    files = []
+    updates = []
+    mode: Literal["file", "other"] = "other"
+
+    for eline in subprocess.run(
+        [
+            "rpm",
+            "-qa",
+            "--queryformat",
+            STARTSEP
+            + "\n[%{FILESIZES} %{FILENAMES}\n]"
+            + TIMESEP
+            + "[%{CHANGELOGTIME} ]\n"
+            + ENDSEP
+            + "%{NAME} %{NEVRA} %{VERSION} %{RELEASE} %{SIZE}\n",
+            "--dbpath",
+            dir,
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.splitlines():
+        line = eline.decode("utf-8")
+
+        if line.startswith(ENDSEP):
+            data = line[len(ENDSEP) :].split(" ")
+            name = data[0]
+            nevra = data[1]
+            version = data[2]
+            release = data[3]
+            size = int(data[4])
+            package = Package(
+                name, nevra, size, tuple(files), tuple(updates), version, release
+            )
+            packages.append(package)
+
+            files = []
+            updates = []
+            mode = "other"
+        elif line.startswith(STARTSEP):
+            mode = "file"
+        elif line.startswith(TIMESEP):
+            updates = [
+                datetime.fromtimestamp(int(t)) for t in line[len(TIMESEP) :].split()
+            ]
+            mode = "other"
+        elif mode == "file":
+            size = int(line[: line.index(" ")])
+            name = line[line.index(" ") + 1 :]
+            files.append(File(name, size))
+
+    return packages
+
+
+def get_packages_rpm_changes(dir: str):
     packages = []
 
     fail_count = 0
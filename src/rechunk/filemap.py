@@ -0,0 +1,300 @@
+import bisect
+import fnmatch
+import re
+from typing import Iterable, Iterator, Mapping, Sequence
+
+import numpy as np
+
+HASH_BYTES = 32
+
+
+class HashTable(Mapping[str, int]):
+    """Maps OSTree content hashes (hex) to their sizes.
+
+    Hashes are stored as a sorted array of binary digests, so each hash has
+    a stable integer id (its position) that the rest of the code can use
+    to index `sizes` or boolean masks instead of hashing hex strings."""
+
+    def __init__(self, digests: np.ndarray, sizes: np.ndarray):
+        self.digests = digests
+        self.sizes = sizes
+        # Byte string view, used for binary search
+        self._keys = digests.view(f"S{HASH_BYTES}").ravel()
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self.sizes)):
+            yield self.hex(i)
+
+    def __getitem__(self, key: str) -> int:
+        return int(self.sizes[self.get_id(key)])
+
+    def __contains__(self, key: object) -> bool:
+        try:
+            self.get_id(key)  # type: ignore
+            return True
+        except (KeyError, ValueError, TypeError):
+            return False
+
+    def get_id(self, key: str) -> int:
+        digest = bytes.fromhex(key)
+        idx = int(np.searchsorted(self._keys, np.bytes_(digest)))
+        if idx >= len(self._keys) or self.digests[idx].tobytes() != digest:
+            raise KeyError(key)
+        return idx
+
+    def hex(self, idx: int) -> str:
+        return self.digests[idx].tobytes().hex()
+
+    def values(self):  # type: ignore
+        return self.sizes.tolist()
+
+    def items(self):  # type: ignore
+        return zip(self, self.sizes.tolist())
+
+
+class FileMap(Mapping[str, str]):
+    """Maps file paths to OSTree content hashes (hex).
+
+    Directory paths are stored once and files as basenames grouped by
+    directory, each with the integer id of its hash in the `HashTable`.
+    The reverse lookup (hash id to path) is built lazily on first use."""
+
+    def __init__(
+        self,
+        dirs: list[str],
+        dir_start: np.ndarray,
+        names: list[str],
+        file_hash: np.ndarray,
+        hashes: HashTable,
+    ):
+        self.dirs = dirs
+        self.dir_start = dir_start
+        self.names = names
+        self.file_hash = file_hash
+        self.hashes = hashes
+        self._dir_index = {d: i for i, d in enumerate(dirs)}
+        self._first_file = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[str]:
+        for i, d in enumerate(self.dirs):
+            for name in self.names[self.dir_start[i] : self.dir_start[i + 1]]:
+                yield f"{d}/{name}"
+
+    def __getitem__(self, fn: str) -> str:
+        idx = self.get_index(fn)
+        if idx is None:
+            raise KeyError(fn)
+        return self.hashes.hex(int(self.file_hash[idx]))
+
+    def __contains__(self, fn: object) -> bool:
+        return isinstance(fn, str) and self.get_index(fn) is not None
+
+    def get_index(self, fn: str) -> int | None:
+        """Returns the file index of `fn` or None if it does not exist."""
+        if "/" not in fn:
+            return None
+        idx = fn.rindex("/")
+        d = self._dir_index.get(fn[:idx], None)
+        if d is None:
+            return None
+
+        name = fn[idx + 1 :]
+        lo = int(self.dir_start[d])
+        hi = int(self.dir_start[d + 1])
+        i = bisect.bisect_left(self.names, name, lo, hi)
+        if i < hi and self.names[i] == name:
+            return i
+        return None
+
+    def get_id(self, fn: str) -> int | None:
+        """Returns the hash id of `fn` or None if it does not exist."""
+        idx = self.get_index(fn)
+        return None if idx is None else int(self.file_hash[idx])
+
+    def get_path(self, idx: int) -> str:
+        """Returns the path of the file with index `idx`."""
+        d = int(np.searchsorted(self.dir_start, idx, side="right")) - 1
+        return f"{self.dirs[d]}/{self.names[idx]}"
+
+    def get_path_of_hash(self, hid: int) -> str:
+        """Returns a path that has the hash id `hid`."""
+        if self._first_file is None:
+            _, first = np.unique(self.file_hash, return_index=True)
+            self._first_file = np.full(len(self.hashes), -1, dtype=np.int64)
+            self._first_file[self.file_hash[first]] = first
+        return self.get_path(int(self._first_file[hid]))
+
+
+class FileMapBuilder:
+    """Accumulates files from a scan and packs them into a `FileMap`."""
+
+    def __init__(self):
+        self._hash_ids: dict[str, int] = {}
+        self._sizes: list[int] = []
+        self._dirs: dict[str, tuple[list[str], list[int]]] = {}
+        self._last_dir = None
+        self._last_entry: tuple[list[str], list[int]] = ([], [])
+
+    def _hash_id(self, fhash: str, size: int):
+        hid = self._hash_ids.get(fhash, None)
+        if hid is None:
+            hid = len(self._sizes)
+            self._hash_ids[fhash] = hid
+            self._sizes.append(size)
+        return hid
+
+    def add(self, d: str, name: str, fhash: str, size: int):
+        # Scans emit files grouped by directory, so cache the last one
+        if d != self._last_dir:
+            entry = self._dirs.get(d, None)
+            if entry is None:
+                entry = self._dirs[d] = ([], [])
+            self._last_dir = d
+            self._last_entry = entry
+        names, ids = self._last_entry
+        names.append(name)
+        ids.append(self._hash_id(fhash, size))
+
+    def add_dir(self, d: str, files: Iterable[tuple[str, str, int]]):
+        for name, fhash, size in files:
+            self.add(d, name, fhash, size)
+
+    def build(self) -> tuple[FileMap, HashTable]:
+        n = len(self._sizes)
+        digests = np.frombuffer(
+            bytes.fromhex("".join(self._hash_ids)), dtype=np.uint8
+        ).reshape(n, HASH_BYTES)
+        order = np.argsort(digests.view(f"S{HASH_BYTES}").ravel(), kind="stable")
+        remap = np.empty(n, dtype=np.int32)
+        remap[order] = np.arange(n, dtype=np.int32)
+        hashes = HashTable(
+            np.ascontiguousarray(digests[order]),
+            np.array(self._sizes, dtype=np.int64)[order],
+        )
+        self._hash_ids = {}
+        self._sizes = []
+        self._last_dir = None
+
+        dirs = sorted(self._dirs)
+        dir_start = np.zeros(len(dirs) + 1, dtype=np.int64)
+        names = []
+        ids = []
+        for i, d in enumerate(dirs):
+            dnames, dids = self._dirs.pop(d)
+            for name, hid in sorted(zip(dnames, dids)):
+                names.append(name)
+                ids.append(hid)
+            dir_start[i + 1] = len(names)
+
+        file_hash = remap[np.array(ids, dtype=np.int64)] if ids else remap[:0]
+        return FileMap(dirs, dir_start, names, file_hash, hashes), hashes
+
+
+class PatternIndex:
+    """Matches all files of a `FileMap` against many fnmatch patterns in a
+    single pass, returning the first pattern that matches each file.
+
+    Patterns are placed in a trie by the directory components of their
+    literal prefix (the part before the first wildcard), along with the
+    partial component that follows. Each directory of the map is walked
+    down the trie once to select the patterns that can match it, which are
+    compiled into one regex with the patterns as ordered alternatives."""
+
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns = list(patterns)
+        # Each trie node is (children, [(pattern index, partial component)])
+        self._root: tuple[dict, list[tuple[int, str]]] = ({}, [])
+        for i, pat in enumerate(self.patterns):
+            literal = re.split(r"[*?[]", pat, maxsplit=1)[0]
+            comps = literal.split("/")
+            node = self._root
+            for comp in comps[:-1]:
+                if not comp:
+                    continue
+                if comp not in node[0]:
+                    node[0][comp] = ({}, [])
+                node = node[0][comp]
+            node[1].append((i, comps[-1]))
+        self._regexes: dict[tuple[int, ...], re.Pattern] = {}
+
+    def _get_regex(self, selected: tuple[int, ...]):
+        if selected not in self._regexes:
+            # Alternatives are tried in order, so the first pattern wins
+            self._regexes[selected] = re.compile(
+                "|".join(
+                    f"(?P<p{i}>{fnmatch.translate(self.patterns[i])})"
+                    for i in selected
+                )
+            )
+        return self._regexes[selected]
+
+    def _select(self, d: str):
+        comps = [c for c in d.split("/") if c]
+        node = self._root
+        selected = []
+        for j in range(len(comps) + 1):
+            if j < len(comps):
+                # Files are below the next component, so it has to
+                # start with the partial component of the pattern
+                selected.extend(i for i, part in node[1] if comps[j].startswith(part))
+                node = node[0].get(comps[j], None)
+                if node is None:
+                    break
+            else:
+                # Files are in this directory, the basename decides
+                selected.extend(i for i, _ in node[1])
+        return tuple(sorted(selected))
+
+    def match(self, file_map: FileMap) -> np.ndarray:
+        """Returns the index of the first pattern matching each file of
+        `file_map`, or -1 if none matches."""
+        out = np.full(len(file_map), -1, dtype=np.int32)
+        if not self.patterns:
+            return out
+
+        names = file_map.names
+        for i, d in enumerate(file_map.dirs):
+            selected = self._select(d)
+            if not selected:
+                continue
+            regex = self._get_regex(selected)
+
+            for idx in range(file_map.dir_start[i], file_map.dir_start[i + 1]):
+                m = regex.match(f"{d}/{names[idx]}")
+                if m is not None:
+                    out[idx] = int(m.lastgroup[1:])  # type: ignore
+        return out
+
+
+if __name__ == "__main__":
+    import time
+
+    # Benchmark the pattern index against fnmatch with an increasing
+    # number of patterns
+    builder = FileMapBuilder()
+    for i in range(300_000):
+        d = f"/usr/{['lib', 'share', 'bin'][i % 3]}/pkg{i // 40}"
+        builder.add(d, f"file{i}.so", f"{i:064x}", i)
+    file_map, _ = builder.build()
+    all_files = list(file_map)
+
+    for n in (10, 50, 250):
+        patterns = [
+            f"/usr/{['lib', 'share', 'bin'][i % 3]}/pkg{i * 23 % 7500}*" for i in range(n)
+        ]
+
+        start = time.perf_counter()
+        PatternIndex(patterns).match(file_map)
+        indexed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for pat in patterns:
+            fnmatch.filter(all_files, pat)
+        baseline = time.perf_counter() - start
+        print(f"{n:4d} patterns: index {indexed:.3f}s, fnmatch {baseline:.3f}s")
@@ -0,0 +1,152 @@
+# Minimal GVariant deserializer for the OSTree metadata objects.
+#
+# OSTree stores commit, dirtree and dirmeta objects as serialized GVariants
+# in "normal form". Only the subset of the format required to read those
+# objects is implemented here (basic types, strings, arrays, structs and
+# dict entries). Variants are returned as raw bytes, since rechunk never
+# needs to look inside the commit metadata.
+#
+# Framing offsets are always little endian. Integers are read big endian,
+# which is how OSTree stores them, so callers get their actual values.
+#
+# Reference: https://people.gnome.org/~desrt/gvariant-serialisation.pdf
+
+from typing import Any, NamedTuple
+
+FIXED_SIZES = {"y": 1, "b": 1, "n": 2, "q": 2, "i": 4, "u": 4, "x": 8, "t": 8}
+INT_FORMATS = {"n": True, "q": False, "i": True, "u": False, "x": True, "t": False}
+
+
+class GType(NamedTuple):
+    code: str
+    children: tuple["GType", ...]
+    align: int
+    fixed: int | None
+
+
+def _parse_type(sig: str, ofs: int = 0) -> tuple[GType, int]:
+    c = sig[ofs]
+    if c in FIXED_SIZES:
+        s = FIXED_SIZES[c]
+        return GType(c, (), s, s), ofs + 1
+    if c in ("s", "o", "g"):
+        return GType(c, (), 1, None), ofs + 1
+    if c == "v":
+        return GType(c, (), 8, None), ofs + 1
+    if c == "a":
+        child, ofs = _parse_type(sig, ofs + 1)
+        return GType(c, (child,), child.align, None), ofs
+    if c in ("(", "{"):
+        end = ")" if c == "(" else "}"
+        children = []
+        ofs += 1
+        while sig[ofs] != end:
+            child, ofs = _parse_type(sig, ofs)
+            children.append(child)
+
+        align = max([ch.align for ch in children], default=1)
+        fixed = None
+        if all(ch.fixed is not None for ch in children):
+            size = 0
+            for ch in children:
+                size = _align(size, ch.align) + ch.fixed  # type: ignore
+            # Unit type has size 1
+            fixed = _align(size, align) if children else 1
+        return GType(c, tuple(children), align, fixed), ofs + 1
+
+    raise ValueError(f"Unsupported GVariant type '{c}' in '{sig}'.")
+
+
+def parse_type(sig: str) -> GType:
+    gtype, ofs = _parse_type(sig)
+    assert ofs == len(sig), f"Trailing characters in GVariant type '{sig}'."
+    return gtype
+
+
+def _align(ofs: int, align: int):
+    return (ofs + align - 1) & ~(align - 1)
+
+
+def _offset_size(size: int):
+    if size <= 0xFF:
+        return 1
+    if size <= 0xFFFF:
+        return 2
+    if size <= 0xFFFFFFFF:
+        return 4
+    return 8
+
+
+def _read_offset(data: memoryview, ofs: int, osz: int):
+    return int.from_bytes(data[ofs : ofs + osz], "little")
+
+
+def _decode(gtype: GType, data: memoryview) -> Any:
+    code = gtype.code
+
+    if code == "y":
+        return data[0] if len(data) else 0
+    if code == "b":
+        return bool(data[0]) if len(data) else False
+    if code in INT_FORMATS:
+        if len(data) != gtype.fixed:
+            return 0
+        # OSTree stores integers big endian
+        return int.from_bytes(data, "big", signed=INT_FORMATS[code])
+    if code in ("s", "o", "g"):
+        # Strip NUL terminator
+        return bytes(data[:-1]).decode("utf-8", errors="surrogateescape")
+    if code == "v":
+        return bytes(data)
+
+    if code == "a":
+        child = gtype.children[0]
+        if child.code == "y":
+            return bytes(data)
+        if child.fixed is not None:
+            n = len(data) // child.fixed
+            return [
+                _decode(child, data[i * child.fixed : (i + 1) * child.fixed])
+                for i in range(n)
+            ]
+
+        size = len(data)
+        if not size:
+            return []
+        osz = _offset_size(size)
+        table = _read_offset(data, size - osz, osz)
+        n = (size - table) // osz
+        out = []
+        start = 0
+        for i in range(n):
+            end = _read_offset(data, table + i * osz, osz)
+            out.append(_decode(child, data[_align(start, child.align) : end]))
+            start = end
+        return out
+
+    # Struct or dict entry
+    size = len(data)
+    osz = _offset_size(size)
+    # Framing offsets are stored in reverse order at the end
+    table_end = size
+    ofs = 0
+    out = []
+    last = len(gtype.children) - 1
+    for i, child in enumerate(gtype.children):
+        ofs = _align(ofs, child.align)
+        if child.fixed is not None:
+            end = ofs + child.fixed
+        elif i == last:
+            end = table_end
+        else:
+            table_end -= osz
+            end = _read_offset(data, table_end, osz)
+        out.append(_decode(child, data[ofs:end]))
+        ofs = end
+    return tuple(out)
+
+
+def decode(sig: str | GType, data: bytes | memoryview) -> Any:
+    """Deserializes `data` with the GVariant type `sig`."""
+    gtype = parse_type(sig) if isinstance(sig, str) else sig
+    return _decode(gtype, memoryview(data))
@@ -0,0 +1,75 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .fedora import get_packages
+from .filemap import FileMap, HashTable
+from .model import Package, get_info
+from .ostree import get_ostree_file_hash, get_ostree_map, run_with_ostree_files
+from .utils import DEFAULT_FORMATTERS, REVISION_TAG, get_commits
+
+logger = logging.getLogger(__name__)
+
+RPMDB_PATH = "/usr/share/rpm/rpmdb.sqlite"
+
+
+def get_previous_revision(previous_manifest: str | list[str] | None):
+    """Reads the git revision of the previous image from its manifest,
+    the same way `get_labels` does."""
+    if not isinstance(previous_manifest, str):
+        return None
+
+    try:
+        with open(previous_manifest, "r") as f:
+            raw = json.load(f)
+        info = get_info(raw)
+        labels = raw.get("Labels", None) or {}
+    except Exception as e:
+        logger.warning(f"Could not read previous revision:\n{e}")
+        return None
+
+    return (info or {}).get("revision", None) or labels.get(REVISION_TAG, None)
+
+
+def _get_packages(repo: str, ref: str, scan=None) -> list[Package]:
+    if scan is None:
+        # Resolve the rpmdb through the commit, so the database can be
+        # read while the tree is still being scanned
+        file_map = {RPMDB_PATH: get_ostree_file_hash(repo, ref, RPMDB_PATH)}
+    else:
+        file_map = scan.result()[0]
+    return run_with_ostree_files(repo, file_map, [RPMDB_PATH], get_packages)
+
+
+def ingest(
+    repo: str,
+    ref: str,
+    scan_cache: str | None = None,
+    git_dir: str | None = None,
+    revision: str | None = None,
+    previous_manifest: str | list[str] | None = None,
+    formatters: dict[str, str] = {},
+) -> tuple[FileMap, HashTable, list[Package], dict[str | None, str]]:
+    """Scans the OSTree ref, reads its packages and fetches the git log
+    concurrently. Each stage mostly waits on IO or a subprocess, so this
+    takes about as long as the slowest one.
+
+    Returns the file and hash maps, the packages and the commit log keyed
+    by the previous revision (for `get_labels`)."""
+    formatters = {**DEFAULT_FORMATTERS, **formatters}
+    prev_rev = get_previous_revision(previous_manifest)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        scan = executor.submit(get_ostree_map, repo, ref, scan_cache)
+        commits = executor.submit(get_commits, git_dir, revision, prev_rev, formatters)
+
+        try:
+            packages = executor.submit(_get_packages, repo, ref).result()
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Could not resolve '{RPMDB_PATH}' directly ({e}). Waiting for the scan."
+            )
+            packages = _get_packages(repo, ref, scan)
+
+        ostree_map, ostree_hash = scan.result()
+        return ostree_map, ostree_hash, packages, {prev_rev: commits.result()}
@@ -1,6 +1,10 @@
 from datetime import datetime
 from typing import Literal, NamedTuple, Sequence, TypedDict
 
+import numpy as np
+
+from .cost import CostModel
+
 INFO_KEY = "dev.hhd.rechunk.info"
 
 
@@ -29,6 +33,24 @@ class MetaPackage(NamedTuple):
     meta: bool = False
 
 
+class PackageArrays(NamedTuple):
+    """Struct-of-arrays view of the meta packages used by the planner.
+
+    The planner refers to packages by their index, which is cheap to hash
+    and copy, and only converts back to `MetaPackage`s for the output."""
+
+    # Only used for logging and output, may be empty when only planning
+    packages: Sequence[MetaPackage]
+    sizes: np.ndarray
+    dedicated: np.ndarray
+    meta: np.ndarray
+    # Packed update rows, see `pack_update_matrix`
+    upd: np.ndarray
+    n_segments: int
+    # Cost of the segments each layer updates in
+    cost: CostModel
+
+
 class ExportInfoV1(TypedDict):
     version: Literal[1]
 
@@ -0,0 +1,264 @@
+import logging
+from typing import Sequence, cast
+
+import numpy as np
+import yaml
+
+from .alg import fill_layers, plan_layers, print_results, process_meta
+from .filemap import HASH_BYTES, FileMap, HashTable
+from .ingest import ingest
+from .model import MetaPackage
+from .ostree import calculate_ostree_layers, dump_ostree_contentmeta
+from .utils import (
+    get_cost_model,
+    get_default_meta_yaml,
+    get_labels,
+    get_package_arrays,
+    get_packed_update_matrix,
+)
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the layers shared by all images
+SHARED_PREFIX = "shared:"
+# Options of meta.yml that are not supported when planning images together
+UNSUPPORTED_OPTIONS = (
+    "unpackaged_group_size",
+    "layer_split_ratio",
+    "compress_sizes",
+    "refine_time",
+    "churn_bytes",
+    "churn_packages",
+)
+
+
+def _get_common_objects(maps: Sequence[FileMap]) -> np.ndarray:
+    # Objects that are at the same paths in every image, as sorted digests.
+    # A layer holds each object with all of its paths, so objects with
+    # other or extra (e.g., hardlinked) paths in an image would make the
+    # shared layers differ between images.
+    paths = []
+    for m in maps:
+        p: dict[str, list[str]] = {}
+        for fn, fhash in m.items():
+            p.setdefault(fhash, []).append(fn)
+        paths.append(p)
+
+    common = [
+        fhash
+        for fhash, fns in paths[0].items()
+        if all(sorted(p.get(fhash, ())) == sorted(fns) for p in paths[1:])
+    ]
+    return np.sort(
+        np.frombuffer(bytes.fromhex("".join(common)), dtype=f"S{HASH_BYTES}")
+    )
+
+
+def _restrict_packages(
+    mapping: dict[str, str],
+    new_packages: Sequence[MetaPackage],
+    hashes: HashTable,
+    common: np.ndarray,
+    shared: bool,
+):
+    # Keeps the files of each package that are (or are not) common to
+    # all images, dropping packages that end up empty
+    keys = hashes.digests.view(f"S{HASH_BYTES}").ravel()
+    digests = np.frombuffer(bytes.fromhex("".join(mapping)), dtype=keys.dtype)
+    hids = np.searchsorted(keys, digests)
+    keep = np.isin(digests, common, assume_unique=True) == shared
+
+    sizes: dict[str, int] = {}
+    out_mapping = {}
+    for (fhash, name), hid, k in zip(mapping.items(), hids.tolist(), keep.tolist()):
+        if k:
+            out_mapping[fhash] = name
+            sizes[name] = sizes.get(name, 0) + int(hashes.sizes[hid])
+
+    out = []
+    for p in new_packages:
+        if p.name in sizes:
+            out.append(p._replace(index=len(out), size=sizes[p.name]))
+    return out_mapping, out
+
+
+def _plan_part(
+    new_packages: Sequence[MetaPackage],
+    mapping: dict[str, str],
+    n_layers: int,
+    meta: dict,
+    result_fn: str | None,
+):
+    # Plans a set of packages into `n_layers` the same way `main` does
+    # for a fresh plan
+    total_size = sum(p.size for p in new_packages)
+    bucket = cast(str, meta.get("update_bucket", "weekly"))
+    upd_packed, n_segments = get_packed_update_matrix(
+        new_packages, cast(int, meta.get("update_horizon", 365)), bucket
+    )
+    cost = get_cost_model(n_segments, bucket, meta.get("update_half_life", 0))
+    pkgs = get_package_arrays(new_packages, upd_packed, n_segments, cost)
+
+    # Dedicated packages can be most of a part, so size the rest of the
+    # layers by what is left for them
+    dedicated = [p for p in new_packages if p.dedicated]
+    layer_size = (total_size - sum(p.size for p in dedicated)) / max(
+        n_layers - len(dedicated), 1
+    )
+    max_layer_size = int(layer_size * cast(float, meta.get("layer_max_ratio", 1.3)))
+    class_size = int(layer_size * cast(float, meta.get("layer_class_ratio", 0)))
+    todo, dedi_layers, prefill = plan_layers(
+        pkgs,
+        cast(str, meta.get("planner", "greedy")),
+        n_layers,
+        int(layer_size * cast(float, meta.get("layer_prefill_ratio", 0.4))),
+        max_layer_size,
+        class_size,
+    )
+    layers = fill_layers(
+        todo, prefill, pkgs, max_layer_size=max_layer_size, class_size=class_size
+    )
+    print_results(dedi_layers, prefill, layers, pkgs, result_fn)
+
+    return calculate_ostree_layers(
+        [[new_packages[i] for i in l] for l in dedi_layers],
+        [[new_packages[i] for i in l] for l in layers],
+        mapping,
+    )
+
+
+def plan_images(
+    repo: str,
+    refs: Sequence[str],
+    contentmeta_fns: Sequence[str],
+    meta_fn: str | None = None,
+    max_layers: int | None = None,
+    labels: Sequence[str] = [],
+    result_fn: str | None = None,
+    scan_cache: str | None = None,
+):
+    """Plans several images of the same repo together, so that they share
+    layers for the content they have in common.
+
+    Files that are in every ref, at the same paths, are planned once into
+    shared layers. Since the shared layers hold the same objects at the same
+    paths in every image, they produce identical blobs that registries and
+    clients only store once. The rest of each image is planned into its own
+    layers, and a contentmeta is written for each ref.
+
+    Plans are always fresh and the options in `UNSUPPORTED_OPTIONS` are
+    ignored, with a warning if they are set."""
+    assert len(refs) == len(contentmeta_fns), "One contentmeta per ref is required."
+    if not meta_fn:
+        meta_fn = get_default_meta_yaml()
+    with open(meta_fn, "r") as f:
+        meta = yaml.safe_load(f)
+    if max_layers is None:
+        max_layers = cast(int, meta.get("max_layers", 39))
+    for option in UNSUPPORTED_OPTIONS:
+        if meta.get(option, None):
+            logger.warning(
+                f"Option '{option}' is not supported when planning images together. Ignoring."
+            )
+
+    images = []
+    maps = []
+    for ref in refs:
+        logger.info(f"Scanning OSTree repo '{repo}' with ref '{ref}' for files.")
+        ostree_map, ostree_hash, packages, _ = ingest(repo, ref, scan_cache=scan_cache)
+        mapping, new_packages = process_meta(
+            meta["meta"], ostree_map, ostree_hash, packages
+        )
+        images.append((ostree_hash, packages, mapping, new_packages))
+        maps.append(ostree_map)
+
+    common = _get_common_objects(maps)
+    maps.clear()
+
+    # The shared part follows the meta packages of the first image
+    hashes, _, mapping, new_packages = images[0]
+    shared_mapping, shared_packages = _restrict_packages(
+        mapping, new_packages, hashes, common, shared=True
+    )
+    shared_size = sum(p.size for p in shared_packages)
+    variants = [
+        _restrict_packages(m, n, h, common, shared=False) for h, _, m, n in images
+    ]
+    variant_sizes = [sum(p.size for p in n) for _, n in variants]
+
+    # Split the layers by how much of the largest image is shared. Each
+    # part needs its dedicated layers, the two small package layers and
+    # at least one more (see `split_special_layers`).
+    def min_layers(packages: Sequence[MetaPackage]):
+        return sum(p.dedicated for p in packages) + 3 if packages else 0
+
+    min_shared = min_layers(shared_packages)
+    min_variant = max(min_layers(n) for _, n in variants)
+    assert (
+        min_shared + min_variant <= max_layers
+    ), f"Not enough layers for the shared and per image layers ({min_shared} + {min_variant} > {max_layers})."
+    image_size = shared_size + max(variant_sizes)
+    n_shared = round(max_layers * shared_size / max(image_size, 1))
+    n_shared = min(max(n_shared, min_shared), max_layers - min_variant)
+    logger.info(
+        f"Shared content: {shared_size / 1e9:.3f} GB of {image_size / 1e9:.3f} GB, "
+        + f"placed in {n_shared}/{max_layers} layers."
+    )
+
+    shared_layers: dict[str, Sequence[str]] = {}
+    shared_out: dict[str, str] = {}
+    if n_shared:
+        logger.info("Planning shared layers.")
+        layers, out = _plan_part(
+            shared_packages,
+            shared_mapping,
+            n_shared,
+            meta,
+            f"{result_fn}.shared" if result_fn else None,
+        )
+        # Distinct names, so they do not collide with the layers of a variant
+        shared_layers = {SHARED_PREFIX + k: v for k, v in layers.items()}
+        shared_out = {h: SHARED_PREFIX + l for h, l in out.items()}
+
+    for i, (ref, contentmeta_fn) in enumerate(zip(refs, contentmeta_fns)):
+        _, packages, _, _ = images[i]
+        v_mapping, v_packages = variants[i]
+        final_layers = dict(shared_layers)
+        ostree_out = dict(shared_out)
+        if v_packages:
+            logger.info(f"Planning layers for '{ref}'.")
+            layers, out = _plan_part(
+                v_packages,
+                v_mapping,
+                max_layers - n_shared,
+                meta,
+                f"{result_fn}.{i}" if result_fn else None,
+            )
+            final_layers.update(layers)
+            ostree_out.update(out)
+
+        new_labels, timestamp = get_labels(
+            labels=labels,
+            version=None,
+            prev_manifest=None,
+            version_fn=None,
+            pretty=None,
+            base_pkg=packages,
+            layers=final_layers,
+            revision=None,
+            git_dir=None,
+            changelog_template=None,
+            changelog_fn=None,
+            info=None,
+        )
+        dump_ostree_contentmeta(
+            dict(sorted(final_layers.items())),
+            ostree_out,
+            contentmeta_fn,
+            new_labels,
+            timestamp,
+        )
+        logger.info(
+            f"Wrote contentmeta for '{ref}' to '{contentmeta_fn}' with "
+            + f"{len(shared_layers)} shared and {len(final_layers) - len(shared_layers)} own layers."
+        )
@@ -1,22 +1,427 @@
 import json
 import logging
 import shutil
+import stat
 import subprocess
 import tempfile
-from typing import Any, Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import IO, Any, Callable, Mapping, NamedTuple, Sequence, TypedDict, cast
 import os
+
+import numpy as np
+
+from .filemap import HASH_BYTES, FileMap, FileMapBuilder, HashTable
+from .gvariant import decode, parse_type
 from .model import MetaPackage
-from .utils import tqdm
+from .utils import load_pickle_cache, save_pickle_cache, tqdm
 
 logger = logging.getLogger(__name__)
 
+COMMIT_TYPE = parse_type("(a{sv}aya(say)sstayay)")
+DIRTREE_TYPE = parse_type("(a(say)a(sayay))")
+OSTREEMETA_XATTR = "user.ostreemeta"
+OSTREEMETA_TYPE = parse_type("(uuua(ayay))")
+
+
+def get_object_fn(repo: str, checksum: str, objtype: str):
+    return os.path.join(repo, "objects", checksum[:2], f"{checksum[2:]}.{objtype}")
+
+
+def read_object(repo: str, checksum: str, objtype: str):
+    with open(get_object_fn(repo, checksum, objtype), "rb") as f:
+        return f.read()
+
+
+def resolve_ref(repo: str, ref: str):
+    if len(ref) == 64 and all(c in "0123456789abcdef" for c in ref):
+        return ref
+
+    for prefix in ("heads", "remotes", "mirrors"):
+        fn = os.path.join(repo, "refs", prefix, ref)
+        if os.path.isfile(fn):
+            with open(fn, "r") as f:
+                return f.read().strip()
+
+    raise FileNotFoundError(f"Ref '{ref}' not found in repo '{repo}'.")
+
+
+def read_commit(repo: str, checksum: str):
+    """Returns the (parent, timestamp, root dirtree, root dirmeta) of a commit."""
+    _, parent, _, _, _, timestamp, tree, meta = decode(
+        COMMIT_TYPE, read_object(repo, checksum, "commit")
+    )
+    return parent.hex() or None, timestamp, tree.hex(), meta.hex()
+
+
+def read_dirtree(repo: str, checksum: str):
+    """Returns the files (name, checksum) and dirs (name, tree) of a dirtree."""
+    files, dirs = decode(DIRTREE_TYPE, read_object(repo, checksum, "dirtree"))
+    return (
+        [(name, csum.hex()) for name, csum in files],
+        [(name, tree.hex()) for name, tree, _ in dirs],
+    )
+
+
+def get_ostree_file_hash(repo: str, ref: str, fn: str):
+    """Resolves the checksum of a single file by following its path through
+    the dirtrees of `ref`, without scanning the rest of the commit."""
+    commit = resolve_ref(repo, ref)
+    _, _, tree, _ = read_commit(repo, commit)
+    *parents, name = fn.strip("/").split("/")
+    for parent in parents:
+        _, dirs = read_dirtree(repo, tree)
+        subtrees = dict(dirs)
+        if parent not in subtrees:
+            raise FileNotFoundError(fn)
+        tree = subtrees[parent]
+
+    files, _ = read_dirtree(repo, tree)
+    checksums = dict(files)
+    if name not in checksums:
+        raise FileNotFoundError(fn)
+    return checksums[name]
+
+
+def get_file_size(repo: str, checksum: str):
+    """Returns the size of a file object, with symlinks being 0 as in `ostree ls`."""
+    fn = get_object_fn(repo, checksum, "file")
+    st = os.lstat(fn)
+    if stat.S_ISLNK(st.st_mode):
+        # Bare repos store symlinks as symlinks
+        return 0
+
+    try:
+        # Bare-user repos store symlinks as regular files and the real
+        # mode in an xattr
+        _, _, mode, _ = decode(OSTREEMETA_TYPE, os.getxattr(fn, OSTREEMETA_XATTR))
+        if stat.S_ISLNK(mode):
+            return 0
+    except OSError:
+        pass
+
+    return st.st_size
+
+
+SCAN_CACHE_VERSION = 1
+SCAN_CACHE_MAX_FILES = 1_500_000
+
+
+class ScanCacheEntry(NamedTuple):
+    generation: int
+    files: tuple[tuple[str, str, int], ...]
+    dirs: tuple[tuple[str, str], ...]
+
+
+class ScanCache(TypedDict):
+    version: int
+    generation: int
+    trees: dict[str, ScanCacheEntry]
 
-def get_ostree_map(repo: str, ref: str):
-    # Prefix has a fixed length
-    # unless filesize is larger than what fits
-    prefix = len("d00555 ")
-    hash_len = 64
 
+def load_scan_cache(fn: str) -> ScanCache:
+    """Loads the dirtree scan cache. Returns an empty cache on any failure."""
+    cache = load_pickle_cache(fn, "scan cache", {"version": SCAN_CACHE_VERSION})
+    if cache is None:
+        return ScanCache(version=SCAN_CACHE_VERSION, generation=0, trees={})
+
+    logger.info(f"Loaded scan cache '{fn}' with {len(cache['trees'])} dirtrees.")
+    return cast(ScanCache, cache)
+
+
+def save_scan_cache(
+    fn: str, cache: ScanCache, max_files: int = SCAN_CACHE_MAX_FILES
+):
+    """Saves the scan cache, evicting the least recently used dirtrees
+    until the cache holds at most `max_files` file entries."""
+    trees = cache["trees"]
+    total = sum(len(e.files) for e in trees.values())
+    evicted = 0
+    if total > max_files:
+        for tree, entry in sorted(trees.items(), key=lambda x: x[1].generation):
+            if total <= max_files:
+                break
+            total -= len(entry.files)
+            trees.pop(tree)
+            evicted += 1
+
+    save_pickle_cache(fn, "scan cache", dict(cache))
+    logger.info(
+        f"Saved scan cache '{fn}' with {len(trees)} dirtrees ({evicted} evicted)."
+    )
+
+
+def _scan_dirtree(repo: str, tree: str, cache: ScanCache | None, generation: int):
+    if cache is not None:
+        entry = cache["trees"].get(tree, None)
+        if entry is not None:
+            if entry.generation < generation:
+                cache["trees"][tree] = entry._replace(generation=generation)
+            return entry.files, entry.dirs, True
+
+    files, dirs = read_dirtree(repo, tree)
+    sized = tuple(
+        (name, fhash, get_file_size(repo, fhash)) for name, fhash in files
+    )
+    if cache is not None:
+        cache["trees"][tree] = ScanCacheEntry(generation, sized, tuple(dirs))
+    return sized, dirs, False
+
+
+# Directories listed by a walk, as their paths and files
+DirListing = list[tuple[str, tuple[tuple[str, str, int], ...]]]
+# Where a walked subtree is listed: the listing, the range of its
+# directories in it and the length of its path, to replace it when reused
+SubtreeSpan = tuple[DirListing, int, int, int]
+
+
+def _walk_dirtree(
+    repo: str,
+    prefix: str,
+    tree: str,
+    pbar,
+    cache: ScanCache | None,
+    generation: int,
+    subtrees: dict[str, SubtreeSpan] | None,
+):
+    # Walk iteratively to avoid recursion limits on deep trees. With
+    # `subtrees`, the span of each walked subtree is recorded once all of it
+    # is listed, and subtrees that were walked before (e.g., in another
+    # commit) are copied from their span instead of walked again.
+    out: DirListing = []
+    hits = 0
+    stack: list[tuple[str, str, int | None]] = [(prefix, tree, None)]
+    while stack:
+        path, tree, start = stack.pop()
+        if start is not None:
+            assert subtrees is not None
+            subtrees[tree] = (out, start, len(out), len(path))
+            continue
+
+        span = subtrees.get(tree, None) if subtrees is not None else None
+        if span is not None:
+            listing, first, last, n = span
+            out.extend((path + p[n:], files) for p, files in listing[first:last])
+            continue
+
+        files, dirs, hit = _scan_dirtree(repo, tree, cache, generation)
+        hits += hit
+        if subtrees is not None:
+            stack.append((path, tree, len(out)))
+        if files:
+            out.append((path, files))
+        pbar.update(len(files))
+        # Reverse to keep the walk in sorted order
+        for name, subtree in reversed(dirs):
+            stack.append((f"{path}/{name}", subtree, None))
+    return out, hits
+
+
+def get_ostree_map_native(
+    repo: str,
+    ref: str,
+    workers: int | None = None,
+    cache: ScanCache | None = None,
+    previous: bool = False,
+    subtrees: dict[str, SubtreeSpan] | None = None,
+) -> tuple[FileMap, HashTable]:
+    """Reads the file map of `ref` by walking the repo objects directly.
+
+    Returns the same `(FileMap, HashTable)` pair as `get_ostree_map`, with
+    top-level subtrees walked in parallel. If a scan cache is provided,
+    dirtrees found in it are not read from the repo. Each scan is a new
+    cache generation, unless `previous` is set (for older commits), where
+    dirtrees are kept older than those of the last scan so that they are
+    evicted first. If provided (e.g., when comparing commits), subtrees in
+    `subtrees` (by dirtree checksum) are reused without walking them, and
+    the walked ones are added to it."""
+    commit = resolve_ref(repo, ref)
+    _, _, root, _ = read_commit(repo, commit)
+    generation = 0
+    if cache is not None:
+        if previous:
+            generation = cache["generation"] - 1
+        else:
+            cache["generation"] += 1
+            generation = cache["generation"]
+
+    builder = FileMapBuilder()
+    pbar = tqdm(desc=f"Reading OSTree ref '{ref}'", unit="files", total=300_000)
+    try:
+        files, dirs, hits = _scan_dirtree(repo, root, cache, generation)
+        builder.add_dir("", files)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _walk_dirtree,
+                    repo,
+                    f"/{name}",
+                    tree,
+                    pbar,
+                    cache,
+                    generation,
+                    subtrees,
+                )
+                for name, tree in dirs
+            ]
+            for fut in futures:
+                sub_dirs, sub_hits = fut.result()
+                for path, files in sub_dirs:
+                    builder.add_dir(path, files)
+                hits += sub_hits
+    finally:
+        pbar.close()
+
+    if cache is not None:
+        logger.info(f"Scan cache hits: {hits} dirtrees.")
+
+    return builder.build()
+
+
+def get_ostree_map(
+    repo: str, ref: str, cache_fn: str | None = None
+) -> tuple[FileMap, HashTable]:
+    cache = load_scan_cache(cache_fn) if cache_fn else None
+    try:
+        out = get_ostree_map_native(repo, ref, cache=cache)
+    except (OSError, ValueError) as e:
+        logger.warning(
+            f"Could not read OSTree objects directly ({e}). Falling back to 'ostree ls'."
+        )
+        return get_ostree_map_ls(repo, ref)
+
+    if cache_fn and cache is not None:
+        try:
+            save_scan_cache(cache_fn, cache)
+        except OSError as e:
+            logger.error(f"Failed to save scan cache '{cache_fn}':\n{e}")
+    return out
+
+
+def _get_changed_files(new: FileMap, old: FileMap):
+    # Files of `new` with content that is not in `old`. Comparing content
+    # instead of paths also skips files that only moved.
+    keys = new.hashes.digests.view(f"S{HASH_BYTES}").ravel()
+    old_keys = old.hashes.digests.view(f"S{HASH_BYTES}").ravel()
+    changed = ~np.isin(keys, old_keys, assume_unique=True)
+    return np.flatnonzero(changed[new.file_hash])
+
+
+def get_commit_changes(
+    repo: str,
+    ref: str,
+    n_commits: int,
+    cache_fn: str | None = None,
+    current: FileMap | None = None,
+) -> list[tuple[datetime, list[str]]]:
+    """Walks back up to `n_commits` parents of `ref` and returns, for each
+    commit, its time and the paths of the files whose content changed
+    compared to its parent.
+
+    Each commit is read like `get_ostree_map`, sharing one scan cache, so
+    only the dirtrees that changed between commits are read. The walk stops
+    early at the first parent that is missing or pruned from the repo. If
+    provided, `current` is used as the file map of `ref`."""
+    cache = load_scan_cache(cache_fn) if cache_fn else ScanCache(
+        version=SCAN_CACHE_VERSION, generation=0, trees={}
+    )
+
+    commit = resolve_ref(repo, ref)
+    parent, timestamp, _, _ = read_commit(repo, commit)
+    # Unchanged subtrees are shared between commits, so walk them once
+    subtrees: dict[str, SubtreeSpan] = {}
+    if current is None:
+        current, _ = get_ostree_map_native(
+            repo, commit, cache=cache, subtrees=subtrees
+        )
+
+    changes = []
+    newer = current
+    for _ in tqdm(range(n_commits), desc="Reading previous commits", unit="commits"):
+        if not parent:
+            break
+        try:
+            date = datetime.fromtimestamp(timestamp)
+        except (OverflowError, OSError, ValueError) as e:
+            logger.warning(
+                f"Commit '{commit}' has an invalid time ({e}). Stopping at {len(changes)} commits."
+            )
+            break
+        try:
+            older, _ = get_ostree_map_native(
+                repo, parent, cache=cache, previous=True, subtrees=subtrees
+            )
+            grandparent, older_ts, _, _ = read_commit(repo, parent)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"Could not read parent commit '{parent}' ({e}). Stopping at {len(changes)} commits."
+            )
+            break
+
+        changed = _get_changed_files(newer, older)
+        changes.append((date, [newer.get_path(int(i)) for i in changed]))
+        commit = parent
+        newer, parent, timestamp = older, grandparent, older_ts
+
+    if cache_fn:
+        try:
+            save_scan_cache(cache_fn, cache)
+        except OSError as e:
+            logger.error(f"Failed to save scan cache '{cache_fn}':\n{e}")
+
+    logger.info(
+        f"Compared {len(changes)} previous commits, with "
+        + f"{sum(len(c) for _, c in changes)} changed files in total."
+    )
+    return changes
+
+
+# `ostree ls -C` prints `<mode> <uid> <gid> <size> <checksum> <path>`,
+# with symlinks followed by ` -> <target>` and directories by a second
+# checksum. Output is read in blocks of whole lines.
+LS_BLOCK_SIZE = 1 << 20
+
+
+def _parse_ls_block(data: bytes, builder: FileMapBuilder):
+    # Splitting each line in C is faster than matching it with a regex
+    add = builder.add
+    count = 0
+    for line in data.decode("utf-8").split("\n"):
+        kind = line[:1]
+        # Skip directories
+        if kind != "-" and kind != "l":
+            continue
+        try:
+            _, _, _, size, fhash, path = line.split(None, 5)
+            if kind == "l":
+                path = path[: path.rindex("->")]
+            d, _, name = path.strip().rpartition("/")
+            add(d, name, fhash, int(size))
+        except ValueError as e:
+            raise ValueError(f"Failed to parse 'ostree ls' line '{line}'.") from e
+        assert len(fhash) == 64, f"Hash fail: {fhash} | {line}"
+        count += 1
+    return count
+
+
+def parse_ostree_ls(stream: IO[bytes], builder: FileMapBuilder, pbar=None):
+    """Parses `ostree ls -C -R` output from `stream` in large blocks."""
+    rest = b""
+    while chunk := stream.read(LS_BLOCK_SIZE):
+        data = rest + chunk
+        end = data.rfind(b"\n") + 1
+        rest = data[end:]
+        count = _parse_ls_block(data[:end], builder)
+        if pbar is not None:
+            pbar.update(count)
+    if rest:
+        count = _parse_ls_block(rest, builder)
+        if pbar is not None:
+            pbar.update(count)
+
+
+def get_ostree_map_ls(repo: str, ref: str) -> tuple[FileMap, HashTable]:
     proc = None
     pbar = tqdm(desc=f"Reading OSTree ref '{ref}'", unit="files", total=300_000)
 
@@ -39,46 +444,8 @@ def get_ostree_map(repo: str, ref: str):
         )
         assert proc.stdout is not None
 
-        mapping = {}
-        hashes = {}
-        while line := proc.stdout.readline().decode("utf-8"):
-            # Skip directories and soft links
-            if line[0] == "d":
-                continue
-
-            ofs = prefix - 1
-            # UID
-            while line[ofs] != " ":
-                ofs += 1
-            # Space after
-            while line[ofs] == " ":
-                ofs += 1
-            # GID
-            while line[ofs] != " ":
-                ofs += 1
-            while line[ofs] == " ":
-                ofs += 1
-            # Link count
-            while line[ofs] != " ":
-                ofs += 1
-            while line[ofs] == " ":
-                ofs += 1
-            # Size
-            size_start = ofs
-            while line[ofs] != " ":
-                ofs += 1
-            size = int(line[size_start:ofs])
-
-            fhash = line[ofs + 1 : ofs + 65]
-            assert " " not in fhash, f"Hash fail: {fhash} | {line}"
-            if line[0] == "l":
-                end_i = line.rindex("->")
-            else:
-                end_i = -1
-            fn = line[ofs + hash_len + 1 : end_i].strip()
-            mapping[fn] = fhash
-            hashes[fhash] = size
-            pbar.update(1)
+        builder = FileMapBuilder()
+        parse_ostree_ls(proc.stdout, builder, pbar)
     finally:
         pbar.close()
         if proc is not None:
@@ -87,7 +454,7 @@ def get_ostree_map(repo: str, ref: str):
     if proc is not None:
         assert proc.poll() == 0, f"OSTree exited with error: {proc.returncode}"
 
-    return mapping, hashes
+    return builder.build()
 
 
 def calculate_ostree_layers(
@@ -106,7 +473,7 @@ def calculate_ostree_layers(
         layer_name = f"dedi:{get_pkg_name(layer[0])}"
         layer_arr = [layer_name]
 
-        unpackaged = len(layer) == 1 and "unpackaged" in layer[0].name
+        unpackaged = len(layer) == 1 and layer[0].name == "unpackaged"
         if unpackaged:
             layer_name = "unpackaged"
             layer_arr = ["dedi:meta:unpackaged"]
@@ -119,7 +486,7 @@ def calculate_ostree_layers(
         layer_name = f"rechunk_layer{i:03d}"
         layer_arr = [get_pkg_name(pkg) for pkg in layer]
 
-        unpackaged = len(layer) == 1 and "unpackaged" in layer[0].name
+        unpackaged = len(layer) == 1 and layer[0].name == "unpackaged"
         if unpackaged:
             layer_name = "unpackaged"
         smeta[layer_name] = layer_arr
@@ -171,7 +538,7 @@ def dump_ostree_contentmeta(
 
 def run_with_ostree_files(
     repo: str,
-    file_map: dict[str, str],
+    file_map: Mapping[str, str],
     fns: Sequence[str],
     callback: Callable[[str], Any],
 ):
@@ -199,5 +566,135 @@ def run_with_ostree_files(
 
 if __name__ == "__main__":
     import sys
-
-    print(sum(get_ostree_map(sys.argv[1], sys.argv[2])[-1].values()))
+    import time
+
+    if sys.argv[1] == "--bench-ls":
+        # Time the `ostree ls` parser against the previous line by line
+        # parser on a recorded dump (`ostree ls -C -R --repo <repo> <ref>
+        # > dump.txt`), and check that both produce the same file map
+        def parse_ostree_ls_lines(stream: IO[bytes], builder: FileMapBuilder):
+            # Reference parser, scans the fields of each decoded line
+            prefix = len("d00555 ")
+            hash_len = 64
+            while line := stream.readline().decode("utf-8"):
+                # Skip directories
+                if line[0] == "d":
+                    continue
+
+                ofs = prefix - 1
+                # UID, GID and link count, each followed by spaces
+                for _ in range(3):
+                    while line[ofs] != " ":
+                        ofs += 1
+                    while line[ofs] == " ":
+                        ofs += 1
+                # Size
+                size_start = ofs
+                while line[ofs] != " ":
+                    ofs += 1
+                size = int(line[size_start:ofs])
+
+                fhash = line[ofs + 1 : ofs + 65]
+                assert " " not in fhash, f"Hash fail: {fhash} | {line}"
+                if line[0] == "l":
+                    end_i = line.rindex("->")
+                else:
+                    end_i = -1
+                fn = line[ofs + hash_len + 1 : end_i].strip()
+                idx = fn.rindex("/")
+                builder.add(fn[:idx], fn[idx + 1 :], fhash, size)
+
+        results = []
+        for name, parse in (
+            ("line", parse_ostree_ls_lines),
+            ("block", parse_ostree_ls),
+        ):
+            with open(sys.argv[2], "rb") as f:
+                start = time.perf_counter()
+                builder = FileMapBuilder()
+                parse(f, builder)
+                mapping, hashes = builder.build()
+                elapsed = time.perf_counter() - start
+            print(f"{name:>5s} parser: {len(mapping)} files in {elapsed:.3f}s.")
+            results.append((mapping, hashes))
+
+        (old_mapping, old_hashes), (new_mapping, new_hashes) = results
+        assert old_mapping == new_mapping, "File mappings differ."
+        assert old_hashes == new_hashes, "File sizes differ."
+        print("Both parsers produce the same file map.")
+    elif sys.argv[1] == "--parity" or sys.argv[3:4] == ["--parity"]:
+        # Compare the native walker against `ostree ls`, on the given repo
+        # or on a small bare-user repo built from a temporary tree
+        def check_parity(repo: str, ref: str):
+            mapping, hashes = get_ostree_map_native(repo, ref)
+            ls_mapping, ls_hashes = get_ostree_map_ls(repo, ref)
+            assert mapping == ls_mapping, "File mappings differ."
+            assert hashes == ls_hashes, "File sizes differ."
+            print(f"Parity ok for {len(mapping)} files.")
+
+        if sys.argv[1] != "--parity":
+            check_parity(sys.argv[1], sys.argv[2])
+            sys.exit(0)
+        if not shutil.which("ostree"):
+            print("Skipping parity check, the 'ostree' CLI is not available.")
+            sys.exit(0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            repo = os.path.join(tmp, "repo")
+            tree = os.path.join(tmp, "tree")
+            # Nested and sibling directories, empty files and directories,
+            # symlinks, hardlinks, files with the same content at several
+            # paths and files with modes that bare-user keeps in
+            # `user.ostreemeta` (executable, setuid, private)
+            for i in range(3):
+                d = os.path.join(tree, "usr", f"d{i}", "sub")
+                os.makedirs(d)
+                for j in range(i + 2):
+                    with open(os.path.join(d, f"f{j}"), "wb") as f:
+                        f.write(os.urandom(1000 * j))
+            os.makedirs(os.path.join(tree, "var", "empty"))
+            shutil.copy(
+                os.path.join(tree, "usr", "d2", "sub", "f3"),
+                os.path.join(tree, "usr", "dup"),
+            )
+            os.symlink("d0/sub/f1", os.path.join(tree, "usr", "link"))
+            os.symlink("/usr/d1", os.path.join(tree, "var", "dirlink"))
+            os.symlink("missing", os.path.join(tree, "var", "dangling"))
+            os.link(
+                os.path.join(tree, "usr", "d1", "sub", "f2"),
+                os.path.join(tree, "usr", "hardlink"),
+            )
+            with open(os.path.join(tree, "top"), "w") as f:
+                f.write("top")
+            for name, mode in (("exec", 0o755), ("suid", 0o4755), ("private", 0o600)):
+                fn = os.path.join(tree, "usr", name)
+                with open(fn, "wb") as f:
+                    f.write(os.urandom(100) + name.encode())
+                os.chmod(fn, mode)
+
+            subprocess.run(
+                ["ostree", "init", "--repo", repo, "--mode=bare-user"], check=True
+            )
+            subprocess.run(
+                [
+                    "ostree",
+                    "commit",
+                    "--repo",
+                    repo,
+                    "--branch",
+                    "parity",
+                    "--no-xattrs",
+                    f"--tree=dir={tree}",
+                ],
+                check=True,
+            )
+            check_parity(repo, "parity")
+
+            # Symlinks and modes are kept in `user.ostreemeta` in bare-user
+            # repos, check that the walker read them
+            mapping, hashes = get_ostree_map_native(repo, "parity")
+            assert hashes[mapping["/usr/link"]] == 0, "Symlink has a size."
+            assert mapping["/usr/hardlink"] == mapping["/usr/d1/sub/f2"]
+            assert hashes[mapping["/usr/exec"]] == 104
+    else:
+        print(sum(get_ostree_map(sys.argv[1], sys.argv[2])[-1].values()))
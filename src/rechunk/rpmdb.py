@@ -0,0 +1,87 @@
+# Minimal reader for the package headers stored in rpmdb.sqlite.
+#
+# Each row of the `Packages` table holds an RPM header "blob": two big
+# endian int32s with the index entry count and data length, followed by
+# the index entries (tag, type, offset, count) and the data store.
+# Only the types needed for reading the tags rechunk uses are decoded.
+
+import sqlite3
+import struct
+from typing import Any, Collection
+
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_SIZE = 1009
+RPMTAG_ARCH = 1022
+RPMTAG_OLDFILENAMES = 1027
+RPMTAG_FILESIZES = 1028
+RPMTAG_CHANGELOGTIME = 1080
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_LONGFILESIZES = 5008
+RPMTAG_LONGSIZE = 5009
+
+RPM_CHAR_TYPE = 1
+RPM_INT8_TYPE = 2
+RPM_INT16_TYPE = 3
+RPM_INT32_TYPE = 4
+RPM_INT64_TYPE = 5
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+INT_FORMATS = {
+    RPM_CHAR_TYPE: "B",
+    RPM_INT8_TYPE: "B",
+    RPM_INT16_TYPE: "H",
+    RPM_INT32_TYPE: "I",
+    RPM_INT64_TYPE: "Q",
+}
+
+
+def _read_value(blob: bytes, ofs: int, rtype: int, count: int):
+    if rtype in INT_FORMATS:
+        return list(struct.unpack_from(f">{count}{INT_FORMATS[rtype]}", blob, ofs))
+    if rtype == RPM_STRING_TYPE:
+        return blob[ofs : blob.index(b"\0", ofs)].decode("utf-8", errors="replace")
+    if rtype in (RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+        # Split in C instead of searching for each terminator
+        return [
+            s.decode("utf-8", errors="replace")
+            for s in blob[ofs:].split(b"\0", count)[:count]
+        ]
+    if rtype == RPM_BIN_TYPE:
+        return blob[ofs : ofs + count]
+    return None
+
+
+def read_header(blob: bytes, tags: Collection[int] | None = None) -> dict[int, Any]:
+    """Decodes the tags in `tags` (or all tags) of an RPM header blob."""
+    il, dl = struct.unpack_from(">ii", blob, 0)
+    store = 8 + 16 * il
+    assert store + dl <= len(blob), "RPM header blob is truncated."
+
+    out = {}
+    for i in range(il):
+        tag, rtype, ofs, count = struct.unpack_from(">iiii", blob, 8 + 16 * i)
+        if tags is not None and tag not in tags:
+            continue
+        out[tag] = _read_value(blob, store + ofs, rtype, count)
+    return out
+
+
+def read_blobs(fn: str) -> list[bytes]:
+    """Returns the header blobs of all packages in an rpmdb.sqlite file,
+    in the order `rpm -qa` lists them."""
+    con = sqlite3.connect(f"file:{fn}?immutable=1", uri=True)
+    try:
+        return [
+            bytes(blob)
+            for (blob,) in con.execute("SELECT blob FROM Packages ORDER BY hnum")
+        ]
+    finally:
+        con.close()
@@ -0,0 +1,308 @@
+import csv
+import itertools
+import logging
+import time
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple, Sequence, cast
+
+import numpy as np
+import yaml
+
+from .alg import (
+    COMPRESSION_RATIO,
+    PullModel,
+    fill_layers,
+    get_plan_stats,
+    get_update_rows,
+    plan_layers,
+    process_meta,
+    split_large_packages,
+)
+from .compress import get_compressed_sizes
+from .filemap import HashTable
+from .ingest import ingest
+from .cost import CostModel
+from .model import PackageArrays
+from .utils import (
+    get_cost_model,
+    get_default_meta_yaml,
+    get_package_arrays,
+    tqdm,
+)
+
+logger = logging.getLogger(__name__)
+
+ARRAY_FIELDS = ("sizes", "dedicated", "meta", "upd")
+
+
+class SweepParams(NamedTuple):
+    planner: str
+    max_layers: int
+    prefill_ratio: float
+    max_layer_ratio: float
+    class_ratio: float
+
+
+class SweepResult(NamedTuple):
+    params: SweepParams
+    # Bytes per update (compressed with `compress_sizes`)
+    bandwidth: float
+    layers_changed: float
+    # Estimated seconds to pull an update (see `PullModel`)
+    update_time: float
+    max_layer_size: int
+    time: float
+
+
+# Planner arrays of the worker, attached from shared memory
+_worker: tuple[PackageArrays, int, PullModel, float, list[SharedMemory]] | None = None
+
+
+def _share_arrays(pkgs: PackageArrays):
+    shms = []
+    specs = {}
+    for field in ARRAY_FIELDS:
+        arr: np.ndarray = getattr(pkgs, field)
+        shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        shms.append(shm)
+        specs[field] = (shm.name, arr.shape, arr.dtype.str)
+    return shms, specs
+
+
+def _init_worker(
+    specs: dict[str, tuple[str, tuple[int, ...], str]],
+    n_segments: int,
+    cost: CostModel,
+    total_size: int,
+    pull: PullModel,
+    ratio: float,
+):
+    global _worker
+
+    # Workers run quietly, the parent reports progress
+    tqdm.hide = True
+    logging.getLogger().setLevel(logging.WARNING)
+
+    shms = []
+    arrays = {}
+    for field, (name, shape, dtype) in specs.items():
+        shm = SharedMemory(name=name)
+        shms.append(shm)
+        arrays[field] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    # Package names are only needed for logging, so workers only get
+    # the shared arrays
+    pkgs = PackageArrays(packages=(), n_segments=n_segments, cost=cost, **arrays)
+    _worker = (pkgs, total_size, pull, ratio, shms)
+
+
+def _evaluate(params: SweepParams) -> SweepResult:
+    assert _worker is not None, "Worker was not initialized."
+    pkgs, total_size, pull, ratio, _ = _worker
+    overhead_size = pull.layer_bytes(ratio)
+
+    start = time.perf_counter()
+    layer_size = total_size / params.max_layers
+    max_layer_size = int(layer_size * params.max_layer_ratio)
+    todo, dedi_layers, prefill = plan_layers(
+        pkgs,
+        params.planner,
+        params.max_layers,
+        int(layer_size * params.prefill_ratio),
+        max_layer_size,
+        int(layer_size * params.class_ratio),
+        layer_overhead=overhead_size,
+    )
+    layers = fill_layers(
+        todo,
+        prefill,
+        pkgs,
+        max_layer_size=max_layer_size,
+        class_size=int(layer_size * params.class_ratio),
+        layer_overhead=overhead_size,
+    )
+    _, bandwidth, changed = get_plan_stats(dedi_layers, layers, pkgs)
+
+    return SweepResult(
+        params=params,
+        bandwidth=bandwidth,
+        layers_changed=changed,
+        update_time=pull.time(bandwidth / ratio, changed),
+        max_layer_size=max(int(pkgs.sizes[l].sum()) for l in dedi_layers + layers),
+        time=time.perf_counter() - start,
+    )
+
+
+def sweep(
+    repo: str,
+    ref: str,
+    meta_fn: str | None = None,
+    planners: Sequence[str] | None = None,
+    max_layers: Sequence[int] | None = None,
+    prefill_ratios: Sequence[float] | None = None,
+    max_layer_ratios: Sequence[float] | None = None,
+    class_ratios: Sequence[float] | None = None,
+    horizon: int | None = None,
+    bucket: str | None = None,
+    half_life: float | None = None,
+    workers: int | None = None,
+    result_fn: str | None = "./sweep.csv",
+    scan_cache: str | None = None,
+    compress_cache: str | None = None,
+):
+    """Plans the image once for every combination of the hyperparameters
+    and reports the predicted bandwidth of each plan.
+
+    The image is scanned once and the planner arrays are placed in shared
+    memory, so each worker process only plans. Parameters that are not
+    provided are read from the meta file."""
+    if not meta_fn:
+        meta_fn = get_default_meta_yaml()
+    with open(meta_fn, "r") as f:
+        meta = yaml.safe_load(f)
+    if not planners:
+        planners = [cast(str, meta.get("planner", "greedy"))]
+    if not max_layers:
+        max_layers = [cast(int, meta.get("max_layers", 39))]
+    if not prefill_ratios:
+        prefill_ratios = [cast(float, meta.get("layer_prefill_ratio", 0.4))]
+    if not max_layer_ratios:
+        max_layer_ratios = [cast(float, meta.get("layer_max_ratio", 1.3))]
+    if not class_ratios:
+        class_ratios = [cast(float, meta.get("layer_class_ratio", 0))]
+    if horizon is None:
+        horizon = cast(int, meta.get("update_horizon", 365))
+    if bucket is None:
+        bucket = cast(str, meta.get("update_bucket", "weekly"))
+    if half_life is None:
+        half_life = cast(float, meta.get("update_half_life", 0))
+    pull = PullModel(
+        cast(float, meta.get("layer_overhead", 0)),
+        cast(int, meta.get("pull_concurrency", 1)),
+        float(meta.get("pull_bandwidth", 12.5e6)),
+    )
+    compress_sizes = cast(bool, meta.get("compress_sizes", False))
+    # Converts planned sizes to compressed bytes
+    ratio = 1 if compress_sizes else COMPRESSION_RATIO
+
+    grid = [
+        SweepParams(*p)
+        for p in itertools.product(
+            planners, max_layers, prefill_ratios, max_layer_ratios, class_ratios
+        )
+    ]
+    # The cluster planner does not use the prefill ratio
+    grid = list(
+        dict.fromkeys(
+            p._replace(prefill_ratio=0) if p.planner == "cluster" else p for p in grid
+        )
+    )
+
+    logger.info(f"Scanning OSTree repo '{repo}' with ref '{ref}' for files.")
+    ostree_map, ostree_hash, packages, _ = ingest(repo, ref, scan_cache=scan_cache)
+    if compress_sizes:
+        compressed = get_compressed_sizes(
+            repo, ostree_hash, cache_fn=compress_cache, fallback_ratio=COMPRESSION_RATIO
+        )
+        ostree_hash = HashTable(ostree_hash.digests, compressed)
+    mapping, new_packages = process_meta(
+        meta["meta"],
+        ostree_map,
+        ostree_hash,
+        packages,
+        int(meta.get("unpackaged_group_size", 0)),
+    )
+    total_size = int(sum(ostree_hash.values()))
+    # Packages are split once, with the layer size of meta.yml
+    split_size = int(
+        total_size
+        / cast(int, meta.get("max_layers", 39))
+        * cast(float, meta.get("layer_split_ratio", 0))
+    )
+    if split_size:
+        mapping, new_packages = split_large_packages(
+            mapping, new_packages, ostree_map, ostree_hash, split_size
+        )
+    upd_packed, n_segments = get_update_rows(
+        repo,
+        ref,
+        mapping,
+        new_packages,
+        ostree_map,
+        ostree_hash,
+        horizon,
+        bucket,
+        cast(str, meta.get("update_source", "changelog")),
+        cast(int, meta.get("update_commits", 30)),
+        scan_cache,
+    )
+    cost = get_cost_model(n_segments, bucket, half_life)
+    pkgs = get_package_arrays(new_packages, upd_packed, n_segments, cost)
+    logger.info(
+        f"Evaluating {len(grid)} plans for {len(new_packages)} meta packages."
+    )
+
+    results = []
+    shms, specs = _share_arrays(pkgs)
+    try:
+        with Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(
+                specs,
+                pkgs.n_segments,
+                cost,
+                total_size,
+                pull,
+                ratio,
+            ),
+        ) as pool:
+            for res in tqdm(
+                pool.imap_unordered(_evaluate, grid), total=len(grid), desc="Sweep"
+            ):
+                results.append(res)
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    results.sort(key=lambda r: (r.update_time, r.bandwidth, r.params))
+    if result_fn:
+        with open(result_fn, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(
+                [
+                    *SweepParams._fields,
+                    "bandwidth_gb",
+                    "layers_changed",
+                    "update_time_s",
+                    "max_layer_gb",
+                    "time_s",
+                ]
+            )
+            for r in results:
+                writer.writerow(
+                    [
+                        *r.params,
+                        f"{r.bandwidth / 1e9:.4f}",
+                        f"{r.layers_changed:.2f}",
+                        f"{r.update_time:.1f}",
+                        f"{r.max_layer_size / 1e9:.4f}",
+                        f"{r.time:.2f}",
+                    ]
+                )
+        logger.info(f"Wrote results to '{result_fn}'.")
+
+    kind = "compressed" if compress_sizes else "uncompressed"
+    log = f"Best plans (update time, {kind} GB and layers changed per update):"
+    for r in results[:10]:
+        p = r.params
+        log += (
+            f"\n - {r.update_time:6.1f} s, {r.bandwidth / 1e9:6.3f} GB, "
+            + f"{r.layers_changed:4.1f} layers: "
+            + f"{p.planner}, max_layers={p.max_layers}, prefill_ratio={p.prefill_ratio}, "
+            + f"max_layer_ratio={p.max_layer_ratio}, class_ratio={p.class_ratio}"
+        )
+    logger.info(log)
+    return results
@@ -1,15 +1,25 @@
 import datetime
 import logging
 import os
+import pickle
 import subprocess
 import sys
 from datetime import datetime
+from itertools import chain
 from typing import Sequence
 
 import numpy as np
 from tqdm.auto import tqdm as tqdm_orig
 
-from .model import INFO_KEY, ExportInfo, MetaPackage, Package, export_v2
+from .cost import CostModel, get_decay_weights
+from .model import (
+    INFO_KEY,
+    ExportInfo,
+    MetaPackage,
+    Package,
+    PackageArrays,
+    export_v2,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +39,13 @@ DEFAULT_FORMATTERS = {
 
 
 class tqdm(tqdm_orig):
+    # Hides all progress bars, e.g., in worker processes
+    hide = False
+
     def __init__(self, *args, **kwargs):
         kwargs["bar_format"] = PBAR_FORMAT
+        if tqdm.hide:
+            kwargs["disable"] = True
         super().__init__(*args, **kwargs)
 
 
@@ -104,47 +119,271 @@ def get_files(dir: str):
     return all_files
 
 
-def get_update_matrix(packages: list[MetaPackage], biweekly: bool = True):
-    # Update matrix for packages
-    # For each package, it lists the times it was updated last year
-    # The frequency is bi-weekly, assuming that a distro might update 2x
-    # per week.
-    if biweekly:
-        n_segments = 106
-    else:
-        n_segments = 53
-    p_upd = np.zeros((len(packages), n_segments), dtype=np.bool)
+def load_pickle_cache(fn: str, name: str, header: dict) -> dict | None:
+    """Loads the `name` cache saved with `save_pickle_cache`. Returns None if
+    it does not exist, cannot be read, is another cache, or has different
+    `header` values (e.g., its version), so that the caller starts with an
+    empty cache."""
+    if not os.path.isfile(fn):
+        return None
 
-    pkg_nochangelog = []
-    curr = datetime.now()
-    for p in packages:
-        i = p.index
-        for u in p.updates:
-            if (curr - u).days > 365:
-                continue
+    try:
+        with open(fn, "rb") as f:
+            cache = pickle.load(f)
+        header = {"cache": name, **header}
+        if any(cache.get(k, None) != v for k, v in header.items()):
+            logger.warning(
+                f"{name.capitalize()} '{fn}' has a different version. Ignoring."
+            )
+            return None
+    except Exception as e:
+        logger.warning(f"Failed to load {name} '{fn}':\n{e}")
+        return None
+
+    return cache
 
-            _, w, d = u.isocalendar()
-            if biweekly:
-                p_upd[i, 2 * w + (d >= 4)] = 1
-            else:
-                p_upd[i, w] = 1
 
-        # Some packages have no changelog, assume they always update
-        # Use updates from all previous years from this. Some packages
-        # may have not updated last year.
-        if len(p.updates) <= 2:
-            p_upd[i] = 1
-            # Dedicated packages we do not care for
-            if not p.dedicated:
-                pkg_nochangelog.append(p.name)
+def save_pickle_cache(fn: str, name: str, cache: dict):
+    """Pickles the `name` cache to `fn` through a temporary file, so that an
+    interrupted save does not leave a truncated cache behind."""
+    tmp_fn = f"{fn}.tmp"
+    with open(tmp_fn, "wb") as f:
+        pickle.dump({"cache": name, **cache}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fn, fn)
 
+
+# Segments per week for each bucket width of the update matrix
+UPDATE_BUCKETS = {"daily": 7, "biweekly": 2, "weekly": 1}
+# Weeks start on Monday, like `isocalendar()`
+_EPOCH_MONDAY = np.datetime64("1970-01-05", "D")
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+def _get_segment_ids(days: np.ndarray, per_week: int):
+    # Segment of each day (counted from a Monday). Twice weekly segments
+    # split the week into Monday to Wednesday and Thursday to Sunday.
+    if per_week == 7:
+        return days
+    if per_week == 2:
+        return 2 * (days // 7) + (days % 7 >= 3)
+    return days // 7
+
+
+# Sources of the update matrix: package changelogs, content changes
+# measured across previous OSTree commits, or both
+UPDATE_SOURCES = ("changelog", "ostree", "both")
+
+
+def _get_dated_segments(
+    index: np.ndarray,
+    updates: Sequence[Sequence[datetime]],
+    horizon: int,
+    per_week: int,
+    n_segments: int,
+):
+    # Flatten the update times of all packages
+    counts = np.array([len(u) for u in updates], dtype=np.int64)
+    # Segments are whole days, so only the date of each update is needed.
+    # Going through ordinals is much faster than numpy's datetime parsing
+    dates = (
+        np.fromiter(
+            map(datetime.toordinal, chain.from_iterable(updates)),
+            dtype=np.int64,
+            count=int(counts.sum()),
+        )
+        - _EPOCH_ORDINAL
+    ).astype("datetime64[D]")
+    rows = np.repeat(index, counts)
+
+    today = np.datetime64(datetime.now().date(), "D")
+    days = (dates - _EPOCH_MONDAY).astype(np.int64)
+    segs = _get_segment_ids(
+        (today - _EPOCH_MONDAY).astype(np.int64), per_week
+    ) - _get_segment_ids(days, per_week)
+    keep = ((today - dates).astype(np.int64) <= horizon) & (segs >= 0) & (segs < n_segments)
+    return rows[keep], segs[keep], counts
+
+
+def get_update_segments(
+    packages: Sequence[MetaPackage],
+    horizon: int = 365,
+    bucket: str = "weekly",
+    history: Sequence[Sequence[datetime]] | None = None,
+    source: str = "changelog",
+    measured: Sequence[int] = (),
+    history_start: datetime | None = None,
+):
+    """Returns the update matrix of `packages` in sparse form, as the
+    package and segment of each update, along with the number of segments.
+
+    Segments are calendar aligned and counted backwards from today (segment
+    0 is the current one), covering the last `horizon` days. Packages with
+    no changelog are assumed to update in every segment.
+
+    `history` holds the times the content of each package changed in
+    previous commits since `history_start` (see `get_content_history`).
+    With the 'ostree' source, it replaces the changelogs, and with 'both'
+    it is added to them. Packages in `measured` (by index) have no
+    changelog, so they always use `history`. When the rest use changelogs,
+    their history is repeated over the horizon to match."""
+    assert bucket in UPDATE_BUCKETS, f"Unknown update bucket '{bucket}'."
+    assert source in UPDATE_SOURCES, f"Unknown update source '{source}'."
+    assert source == "changelog" or history is not None, "History is required."
+    per_week = UPDATE_BUCKETS[bucket]
+    n_segments = -(-horizon * per_week // 7)
+    index = np.array([p.index for p in packages], dtype=np.int64)
+    is_measured = np.zeros(len(packages), dtype=np.bool)
+    if history is not None:
+        is_measured[list(measured)] = True
+
+    rows = segs = np.zeros(0, dtype=np.int64)
+    if history is not None:
+        rows, segs, _ = _get_dated_segments(
+            index, [history[i] for i in index], horizon, per_week, n_segments
+        )
+        if source == "changelog":
+            keep = is_measured[rows]
+            rows, segs = rows[keep], segs[keep]
+        if source != "ostree" and history_start is not None and len(index):
+            # Repeat the measured window of the packages without changelogs
+            # over the horizon, as if they keep updating at the same rate
+            _, start, _ = _get_dated_segments(
+                index[:1], [[history_start]], horizon, per_week, n_segments
+            )
+            window = int(start[0]) + 1 if len(start) else n_segments
+            rep = is_measured[rows]
+            t_rows, t_segs = rows[rep], segs[rep]
+            for offset in range(window, n_segments, window):
+                rows = np.concatenate([rows, t_rows])
+                segs = np.concatenate([segs, t_segs + offset])
+            keep = segs < n_segments
+            rows, segs = rows[keep], segs[keep]
+    if source == "ostree":
+        # Measured changes cover packages without changelogs as well
+        return rows, segs, n_segments
+
+    c_rows, c_segs, counts = _get_dated_segments(
+        index, [p.updates for p in packages], horizon, per_week, n_segments
+    )
+    keep = ~is_measured[c_rows]
+    rows = np.concatenate([rows, c_rows[keep]])
+    segs = np.concatenate([segs, c_segs[keep]])
+
+    # Some packages have no changelog, assume they always update
+    # Use updates from all previous years from this. Some packages
+    # may have not updated last year.
+    nochangelog = (counts <= 2) & ~is_measured
+    if nochangelog.any():
+        rows = np.concatenate([rows, np.repeat(index[nochangelog], n_segments)])
+        segs = np.concatenate(
+            [segs, np.tile(np.arange(n_segments), int(nochangelog.sum()))]
+        )
+
+    # Dedicated packages we do not care for
+    pkg_nochangelog = [
+        p.name for p, nc in zip(packages, nochangelog) if nc and not p.dedicated
+    ]
     logger.info(
         f"Found {len(pkg_nochangelog)} packages with no changelog:\n{str(sorted(pkg_nochangelog))}"
     )
 
+    return rows, segs, n_segments
+
+
+def get_update_matrix(
+    packages: Sequence[MetaPackage],
+    biweekly: bool = True,
+    horizon: int = 365,
+    bucket: str | None = None,
+):
+    # Update matrix for packages
+    # For each package, it lists the times it was updated in the horizon
+    # The frequency is bi-weekly by default, assuming that a distro might
+    # update 2x per week.
+    if bucket is None:
+        bucket = "biweekly" if biweekly else "weekly"
+    rows, segs, n_segments = get_update_segments(packages, horizon, bucket)
+    p_upd = np.zeros((len(packages), n_segments), dtype=np.bool)
+    p_upd[rows, segs] = True
     return p_upd
 
 
+def get_cost_model(n_segments: int, bucket: str, half_life: float | None):
+    """Returns the cost model for an update matrix with `n_segments` of
+    `bucket` width. With a `half_life` (days), updates count less the older
+    they are, otherwise all segments count the same."""
+    if not half_life:
+        return CostModel(n_segments)
+    segment_days = 7 / UPDATE_BUCKETS[bucket]
+    return CostModel(
+        n_segments, get_decay_weights(n_segments, segment_days, half_life)
+    )
+
+
+def get_packed_update_matrix(
+    packages: Sequence[MetaPackage],
+    horizon: int = 365,
+    bucket: str = "weekly",
+    history: Sequence[Sequence[datetime]] | None = None,
+    source: str = "changelog",
+    measured: Sequence[int] = (),
+    history_start: datetime | None = None,
+):
+    """Like `get_update_matrix`, but scatters the updates directly into
+    packed rows (see `pack_update_matrix`), so long horizons do not need
+    a dense matrix. Returns the packed rows and the number of segments."""
+    rows, segs, n_segments = get_update_segments(
+        packages, horizon, bucket, history, source, measured, history_start
+    )
+    packed = np.zeros((len(packages), -(-n_segments // 64)), dtype=np.uint64)
+    np.bitwise_or.at(
+        packed,
+        (rows, segs >> 6),
+        np.left_shift(np.uint64(1), (segs & 63).astype(np.uint64)),
+    )
+    if sys.byteorder == "big":
+        # Match the byte order of `pack_update_matrix`
+        packed = packed.byteswap()
+    return packed, n_segments
+
+
+def pack_update_matrix(upd_matrix: np.ndarray):
+    """Packs the rows of a boolean update matrix into uint64 words, so that
+    layer unions are bitwise ORs and update counts are popcounts."""
+    packed = np.packbits(upd_matrix, axis=1, bitorder="little")
+    pad = -packed.shape[1] % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def get_package_arrays(
+    packages: Sequence[MetaPackage],
+    upd_matrix: np.ndarray,
+    n_segments: int | None = None,
+    cost: CostModel | None = None,
+):
+    """Creates the planner arrays for `packages`, whose indices have to match
+    their positions. `upd_matrix` is either a boolean update matrix or, if
+    `n_segments` is provided, an already packed one. Without a `cost`
+    model, all segments weigh the same."""
+    assert all(
+        p.index == i for i, p in enumerate(packages)
+    ), "Package indices do not match their positions."
+    if n_segments is None:
+        n_segments = upd_matrix.shape[1]
+        upd_matrix = pack_update_matrix(upd_matrix)
+    return PackageArrays(
+        packages=packages,
+        sizes=np.array([p.size for p in packages], dtype=np.int64),
+        dedicated=np.array([p.dedicated for p in packages], dtype=np.bool),
+        meta=np.array([p.meta for p in packages], dtype=np.bool),
+        upd=upd_matrix,
+        n_segments=n_segments,
+        cost=cost if cost is not None else CostModel(n_segments),
+    )
+
+
 def get_commits(
     git_dir: str | None,
     revision: str | None,
@@ -259,6 +498,7 @@ def get_labels(
     changelog_fn: str | None,
     info: ExportInfo | None,
     formatters: dict[str, str] = {},
+    commits: dict[str | None, str] | None = None,
 ) -> tuple[dict[str, str], str]:
     formatters = {**DEFAULT_FORMATTERS, **formatters}
 
@@ -314,12 +554,14 @@ def get_labels(
 
     blacklist = dict()
     blacklist[INFO_KEY] = BLACKLIST_KEY
-    commit_str = get_commits(
-        git_dir,
-        revision,
-        (info or {}).get("revision", None) or prev_labels.get(REVISION_TAG, None),
-        formatters=formatters,
+    prev_rev = (info or {}).get("revision", None) or prev_labels.get(
+        REVISION_TAG, None
     )
+    if commits is not None and prev_rev in commits:
+        # Fetched during ingest
+        commit_str = commits[prev_rev]
+    else:
+        commit_str = get_commits(git_dir, revision, prev_rev, formatters=formatters)
 
     def process_label(key: str, value: str):
         if "<changelog>" in value: